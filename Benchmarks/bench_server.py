@@ -0,0 +1,430 @@
+###########################################################
+#                                                         #
+#                     ScriptWizard                        #
+#              OBSCYRUS SERVER BENCHMARKS                 #
+#          Server overhead, no model required             #
+#                                                         #
+###########################################################
+
+# Drives the real Obscyrus1.1.py app (Socket.IO chat and convo events, /search, workspace and
+# codes endpoints) with simulated clients against a throwaway data directory. The model is a
+# deterministic fake Llama with a configurable prompt rate, token rate and latency, so the
+# numbers measure the server itself and stay comparable between commits on a CPU-only box.
+#
+#   python Benchmarks/bench_server.py --output before.json
+#   python Benchmarks/bench_server.py --compare before.json
+#
+# Results are JSON: per scenario p50/p95/p99/mean latency in ms, throughput per second and, for
+# chat, time to first token. Socket.IO replies are polled every --poll-interval seconds, which
+# bounds the resolution of the chat timings.
+
+import os
+import sys
+import json
+import math
+import time
+import types
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import importlib.util
+
+import numpy as np
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+words = ('flask socketio server route json workspace editor model token stream cache index search '
+         'python html css javascript button layout render socket event handler queue thread file '
+         'config database request response session history prompt code function class import').split()
+
+# Fake llama_cpp
+class LlamaState:
+    def __init__(self, input_ids):
+        self.input_ids = np.array(input_ids, dtype=np.int64)
+        self.scores = np.zeros((0, 0), dtype=np.float32)
+        self.n_tokens = len(input_ids)
+        self.llama_state_size = 64 * len(input_ids) + 64
+
+class FakeLlama:
+    prompt_tokens_per_second = 2000.0
+    tokens_per_second = 200.0
+    latency = 0.01
+    response_tokens = 120
+
+    def __init__(self, model_path, **kwargs):
+        self.model_path = model_path
+        self.kwargs = kwargs
+        self.input_ids = []
+
+    def n_ctx(self):
+        return self.kwargs.get('n_ctx', 18000)
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [int(hashlib.md5(word).hexdigest()[:6], 16) for word in text.split()]
+        return ([1] if add_bos else []) + tokens
+
+    def save_state(self):
+        return LlamaState(self.input_ids)
+
+    def load_state(self, state):
+        self.input_ids = list(state.input_ids)
+
+    def embed(self, text):
+        vector = np.zeros(64, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode('utf-8')).hexdigest()[:6], 16) % 64] += 1
+        return vector.tolist()
+
+    def response_for(self, messages):
+        rng = random.Random(hashlib.md5(messages[-1]['content'].encode('utf-8')).hexdigest())
+        n_code = self.response_tokens // 2
+        text = ['Here', 'you', 'go:'] + [rng.choice(words) for _ in range(self.response_tokens - n_code - 3)]
+        code = [rng.choice(words) + ('\n' if i % 8 == 7 else '') for i in range(n_code)]
+        return [token + ' ' for token in text] + ['\n```python\n'] + [token + ' ' for token in code] + ['\n```\n']
+
+    def prefill(self, messages):
+        prompt = self.tokenize(' '.join(message['content'] for message in messages).encode('utf-8'))
+        # Only the part after the longest common prefix with the current state is evaluated
+        common = 0
+        for a, b in zip(self.input_ids, prompt):
+            if a != b:
+                break
+            common += 1
+        time.sleep(self.latency + (len(prompt) - common) / self.prompt_tokens_per_second)
+        self.input_ids = prompt
+
+    def create_chat_completion(self, messages, stream=False, max_tokens=None, **kwargs):
+        self.prefill(messages)
+        tokens = self.response_for(messages)[:max_tokens or None]
+        if not stream:
+            time.sleep(len(tokens) / self.tokens_per_second)
+            return {'choices': [{'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'}]}
+
+        def generate():
+            for token in tokens:
+                time.sleep(1 / self.tokens_per_second)
+                self.input_ids.append(0)
+                yield {'choices': [{'delta': {'content': token}, 'finish_reason': None}]}
+        return generate()
+
+def install_fake_llama():
+    module = types.ModuleType('llama_cpp')
+    module.Llama = FakeLlama
+    module.LlamaState = LlamaState
+    sys.modules['llama_cpp'] = module
+    # Pickled KV snapshots refer to llama_cpp.LlamaState
+    LlamaState.__module__ = 'llama_cpp'
+
+# Synthetic data
+def random_text(rng, n_words):
+    return ' '.join(rng.choice(words) for _ in range(n_words))
+
+def make_gguf(path):
+    def gguf_string(value):
+        data = value.encode('utf-8')
+        return len(data).to_bytes(8, 'little') + data
+    entries = [(b'general.architecture', 8, gguf_string('llama')), (b'general.file_type', 4, (15).to_bytes(4, 'little'))]
+    header = b'GGUF' + (3).to_bytes(4, 'little') + (0).to_bytes(8, 'little') + len(entries).to_bytes(8, 'little')
+    with open(path, 'wb') as f:
+        f.write(header + b''.join(len(key).to_bytes(8, 'little') + key + value_type.to_bytes(4, 'little') + value for key, value_type, value in entries))
+
+def build_corpus(ob, rng, n_convos, n_workspace_files, n_codes):
+    for i in range(n_convos):
+        id = f'bench-{i:06d}'
+        messages = []
+        for turn in range(rng.randint(2, 12)):
+            messages.append({'role': 'user', 'content': random_text(rng, rng.randint(5, 40))})
+            messages.append({'role': 'assistant', 'content': random_text(rng, rng.randint(20, 200))})
+        ob.write_convo_file(id, f'Bench convo {i}', messages)
+        ob.convos[id] = {'name': f'Bench convo {i}', 'created': time.time(), 'updated': time.time(), 'message_count': len(messages)}
+    ob.save_convo_index(ob.convos)
+    for i in range(n_workspace_files):
+        rel_path = f'src/module_{i % 20:02d}/file_{i:05d}.py'
+        path = os.path.join(ob.workspace_dir, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(''.join(f'def {rng.choice(words)}_{i}_{j}(x):\n    return "{random_text(rng, 8)}"\n\n' for j in range(rng.randint(5, 60))))
+    for i in range(n_codes):
+        with open(os.path.join(ob.codes_dir, f'code_{i:04d}.py'), 'w') as f:
+            f.write(random_text(rng, 400))
+
+# Measurement
+def summarize(samples, wall_seconds, errors=0):
+    ordered = sorted(samples)
+    def percentile(p):
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))] * 1000, 3)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        'throughput_per_s': round(len(ordered) / wall_seconds, 2) if wall_seconds else None,
+    }
+
+def run_clients(n_clients, work):
+    results = [[] for _ in range(n_clients)]
+    threads = [threading.Thread(target=work, args=(i, results[i])) for i in range(n_clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [sample for client in results for sample in client], time.perf_counter() - started
+
+def wait_for(client, names, timeout, poll_interval, on_event=None):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        for event in client.get_received():
+            if on_event:
+                on_event(event)
+            if event['name'] in names:
+                return event
+        time.sleep(poll_interval)
+    return None
+
+class Bench:
+    def __init__(self, ob, args):
+        self.ob = ob
+        self.args = args
+
+    def connect(self, model):
+        client = self.ob.socketio.test_client(self.ob.app)
+        client.emit('select_model', {'model': model})
+        wait_for(client, ('success',), 30, self.args.poll_interval)
+        client.get_received()
+        return client
+
+    def chat_scenario(self, prompts, no_cache=True):
+        args = self.args
+        ttft, errors = [], [0]
+
+        def work(i, samples):
+            client = self.connect('bench.gguf')
+            for prompt in prompts(i):
+                client.emit('convo_create')
+                client.get_received()
+                first = []
+                started = time.perf_counter()
+                client.emit('chat', {'prompt': prompt, 'no_cache': no_cache})
+
+                def on_event(event):
+                    if not first and event['name'] in ('text_token', 'code_token'):
+                        first.append(time.perf_counter() - started)
+                event = wait_for(client, ('end_response', 'error'), args.timeout, args.poll_interval, on_event)
+                if event is None or event['name'] == 'error':
+                    errors[0] += 1
+                    continue
+                samples.append(time.perf_counter() - started)
+                ttft.extend(first)
+            client.disconnect()
+
+        samples, wall = run_clients(args.clients, work)
+        result = summarize(samples, wall, errors[0])
+        first = summarize(ttft, wall)
+        result.update({'ttft_p50_ms': first['p50_ms'], 'ttft_p95_ms': first['p95_ms'], 'ttft_p99_ms': first['p99_ms']})
+        result['tokens_per_s'] = round(len(samples) * FakeLlama.response_tokens / wall, 1) if wall else None
+        return result
+
+    def convo_scenario(self):
+        args = self.args
+        ids = list(self.ob.convos)
+        results = {}
+        for event, make_data in (('convo_list', lambda rng: None), ('convo_load', lambda rng: {'id': rng.choice(ids)})):
+            def work(i, samples, event=event, make_data=make_data):
+                rng = random.Random(args.seed + i)
+                client = self.ob.socketio.test_client(self.ob.app)
+                for _ in range(args.requests):
+                    data = make_data(rng)
+                    started = time.perf_counter()
+                    client.emit(event, data) if data is not None else client.emit(event)
+                    client.get_received()
+                    samples.append(time.perf_counter() - started)
+                client.disconnect()
+            samples, wall = run_clients(args.clients, work)
+            results[event] = summarize(samples, wall)
+
+        def save_work(i, samples):
+            rng = random.Random(args.seed + i)
+            client = self.connect('bench.gguf')
+            for n in range(args.requests):
+                client.emit('convo_load', {'id': rng.choice(ids)})
+                client.emit('chat', {'prompt': random_text(rng, 12), 'no_cache': True})
+                wait_for(client, ('end_response', 'error'), args.timeout, args.poll_interval)
+                started = time.perf_counter()
+                client.emit('convo_save', {'name': f'Saved {i}-{n}'})
+                client.get_received()
+                samples.append(time.perf_counter() - started)
+            client.disconnect()
+        samples, wall = run_clients(args.clients, save_work)
+        # Each client also chats between saves; throughput counts only the time spent saving
+        results['convo_save'] = summarize(samples, sum(samples) / args.clients)
+        return results
+
+    def http_scenario(self, requests_for):
+        args = self.args
+        errors = [0]
+
+        def work(i, samples):
+            rng = random.Random(args.seed + i)
+            http = self.ob.app.test_client()
+            for _ in range(args.requests):
+                method, url, kwargs = requests_for(rng)
+                started = time.perf_counter()
+                response = http.open(url, method=method, **kwargs)
+                elapsed = time.perf_counter() - started
+                if response.status_code >= 400:
+                    errors[0] += 1
+                else:
+                    samples.append(elapsed)
+        samples, wall = run_clients(args.clients, work)
+        return summarize(samples, wall, errors[0])
+
+    def workspace_scenarios(self):
+        ob = self.ob
+        ob.ensure_workspace_index()
+        files = ob.list_workspace_files()
+        manifest = []
+        for rel_path in files:
+            path = os.path.join(ob.workspace_dir, rel_path)
+            manifest.append({'path': rel_path, 'size': os.path.getsize(path), 'sha256': ob.hash_file_blocking(path)})
+        results = {}
+        http = ob.app.test_client()
+        started = time.perf_counter()
+        http.post('/api/workspace_sync', json={'files': manifest, 'delete_missing': False})
+        results['workspace_sync_unchanged'] = summarize([time.perf_counter() - started], time.perf_counter() - started)
+        results['workspace_upload'] = self.http_scenario(lambda rng: ('PUT', f'/api/workspace_file?path=upload/c{rng.randrange(10 ** 9)}.py', {'data': random_text(rng, 300).encode('utf-8')}))
+        results['workspace_list'] = self.http_scenario(lambda rng: ('GET', '/api/workspace_files', {}))
+        results['workspace_tree'] = self.http_scenario(lambda rng: ('GET', f'/api/workspace_tree?path=src/module_{rng.randrange(20):02d}/', {}))
+        results['workspace_read'] = self.http_scenario(lambda rng: ('POST', '/api/get_workspace_code', {'json': {'filename': rng.choice(files)}}))
+        results['search_code'] = self.http_scenario(lambda rng: ('GET', f'/api/search_code?q={rng.choice(words)}', {}))
+        return results
+
+    def codes_scenarios(self):
+        return {
+            'codes_list': self.http_scenario(lambda rng: ('GET', '/api/codes', {})),
+            'codes_save': self.http_scenario(lambda rng: ('POST', '/api/save_code', {'json': {'filename': f'bench_{rng.randrange(10 ** 9)}.py', 'code': random_text(rng, 200)}})),
+            'codes_read': self.http_scenario(lambda rng: ('POST', '/api/get_code', {'json': {'filename': f'code_{rng.randrange(self.args.codes):04d}.py'}})),
+        }
+
+    def run(self):
+        args = self.args
+        results = {}
+        chat_prompts = lambda i: [f'/generate {random_text(random.Random(args.seed * 1000 + i * 100 + n), 10)}' for n in range(args.requests)]
+        results['chat'] = self.chat_scenario(chat_prompts)
+        # The same prompts again in fresh conversations: served from the response cache
+        results['chat_cached'] = self.chat_scenario(chat_prompts, no_cache=False)
+        results['search'] = self.chat_scenario(lambda i: [f'/search {random_text(random.Random(args.seed + i * 100 + n), 3)}' for n in range(args.requests)])
+        results.update(self.convo_scenario())
+        results.update(self.workspace_scenarios())
+        results.update(self.codes_scenarios())
+        return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(current, baseline):
+    lines = []
+    for scenario, result in current['results'].items():
+        before = baseline.get('results', {}).get(scenario)
+        if not before:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'ttft_p50_ms', 'throughput_per_s'):
+            if result.get(key) and before.get(key):
+                change = (result[key] - before[key]) / before[key] * 100
+                lines.append(f'{scenario:28} {key:18} {before[key]:>10} -> {result[key]:>10} ({change:+.1f}%)')
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Obscyrus server with a fake model')
+    parser.add_argument('--clients', type=int, default=8, help='simulated concurrent clients')
+    parser.add_argument('--requests', type=int, default=5, help='requests per client per scenario')
+    parser.add_argument('--convos', type=int, default=2000, help='synthetic conversations')
+    parser.add_argument('--workspace-files', type=int, default=2000, help='synthetic workspace files')
+    parser.add_argument('--codes', type=int, default=200, help='synthetic saved codes')
+    parser.add_argument('--token-rate', type=float, default=200.0, help='fake model decode tokens per second')
+    parser.add_argument('--prompt-rate', type=float, default=2000.0, help='fake model prefill tokens per second')
+    parser.add_argument('--latency', type=float, default=0.01, help='fake model fixed latency per completion, seconds')
+    parser.add_argument('--response-tokens', type=int, default=120)
+    parser.add_argument('--search-mode', choices=['bm25', 'semantic', 'hybrid'], default=None, help="defaults to the server's setting; semantic and hybrid embed the corpus with the fake model")
+    parser.add_argument('--poll-interval', type=float, default=0.001)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    FakeLlama.tokens_per_second = args.token_rate
+    FakeLlama.prompt_tokens_per_second = args.prompt_rate
+    FakeLlama.latency = args.latency
+    FakeLlama.response_tokens = args.response_tokens
+    install_fake_llama()
+
+    root = tempfile.mkdtemp(prefix='obscyrus-bench-')
+    for name in ('GGUFs', 'Convos', 'Codes', 'Workspace'):
+        os.makedirs(os.path.join(root, 'Obscyrus', name))
+    make_gguf(os.path.join(root, 'Obscyrus', 'GGUFs', 'bench.gguf'))
+    make_gguf(os.path.join(root, 'Obscyrus', 'GGUFs', 'embed.gguf'))
+    os.environ['OBSCYRUS_ROOT'] = root
+    started = time.perf_counter()
+    spec = importlib.util.spec_from_file_location('obscyrus', os.path.join(repo_dir, 'Obscyrus1.1.py'))
+    ob = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ob)
+    import_seconds = time.perf_counter() - started
+    if args.search_mode:
+        ob.search_mode = args.search_mode
+    if ob.search_mode != 'bm25':
+        ob.embedding_model = 'embed.gguf'
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    build_corpus(ob, rng, args.convos, args.workspace_files, args.codes)
+    corpus_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    ob.ensure_search_index()
+    ob.ensure_workspace_index()
+    ob.ensure_code_index()
+    deadline = time.time() + args.timeout
+    while ob.code_index_building() and time.time() < deadline:
+        time.sleep(0.05)
+    if ob.embedding_model is not None:
+        # The first save of the vectors marks the end of the initial embedding pass
+        ob.ensure_vectors()
+        deadline = time.time() + args.timeout
+        while not os.path.exists(ob.vectors_meta_path) and time.time() < deadline:
+            time.sleep(0.05)
+    index_seconds = time.perf_counter() - started
+
+    results = Bench(ob, args).run()
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'startup': {'import_ms': round(import_seconds * 1000, 1), 'corpus_ms': round(corpus_seconds * 1000, 1), 'index_ms': round(index_seconds * 1000, 1)},
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print(compare(report, json.load(f)))
+    # Background workers (inference, embeddings, index flushes) may still be writing: exit without joining them
+    shutil.rmtree(root, ignore_errors=True)
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,377 @@
 import os
-from huggingface_hub import hf_hub_download, login
+import sys
+import json
+import time
+import struct
+import hashlib
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+# Downloads the Obscyrus GGUF in parallel byte ranges into <file>.part. Finished ranges are recorded
+# in a <file>.part.json journal, so an interrupted download resumes where it stopped. The file is
+# hashed in order as the ranges complete and checked against the SHA-256 the Hub publishes for it
+# (the LFS oid in X-Linked-Etag). Its GGUF header is validated before it is moved into place.
+# --endpoint points at a Hub mirror or any HTTP server laid out as <endpoint>/<repo>/resolve/main/<file>;
+# --mirror copies from a local directory instead, e.g. a USB drive for offline installs.
+
+# Repository details
+repo_id = "ScriptWizarddd/Obscyrus-8B-ClaudeFT"  # From the provided URL
+filename = "Obscyrus1-8B-ClaudeFT.gguf"  # Assuming this is the file name based on previous code
+hub_endpoint = "https://huggingface.co"
 
 # Path to store the token
 token_file = 'hf_token.txt'
 
-# Check if token file exists
-if os.path.exists(token_file):
-    with open(token_file, 'r') as f:
-        hf_token = f.read().strip()
-    print("Loaded Hugging Face token from hf_token.txt.")
-else:
+chunk_size = 32 * 1024 * 1024
+chunk_retries = 5
+read_size = 1024 * 1024
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Download the Obscyrus GGUF model')
+    parser.add_argument('--endpoint', default=os.environ.get('HF_ENDPOINT', hub_endpoint), help='Hub or mirror base URL')
+    parser.add_argument('--mirror', help='local directory holding the GGUF (and optionally <file>.sha256)')
+    parser.add_argument('--repo', default=repo_id, help='repository id')
+    parser.add_argument('--file', default=filename, help='file name in the repository')
+    parser.add_argument('--output-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "GGUFs"),
+                        help='where to save the model (default: ./GGUFs next to this script)')
+    parser.add_argument('--workers', type=int, default=8, help='parallel range requests')
+    parser.add_argument('--sha256', help='expected SHA-256, when the source does not publish one')
+    return parser.parse_args()
+
+def load_token(endpoint):
+    if os.environ.get('HF_TOKEN'):
+        return os.environ['HF_TOKEN']
+    # Check if token file exists
+    if os.path.exists(token_file):
+        with open(token_file, 'r') as f:
+            hf_token = f.read().strip()
+        print("Loaded Hugging Face token from hf_token.txt.")
+        return hf_token
+    if endpoint != hub_endpoint:
+        return ''
     # Prompt user for token
-    hf_token = input("Enter your Hugging Face token (required for download): ").strip()
+    hf_token = input("Enter your Hugging Face token (leave blank for public access): ").strip()
     # Save to file
     with open(token_file, 'w') as f:
         f.write(hf_token)
     print("Hugging Face token saved to hf_token.txt for future use.")
+    return hf_token
 
-# Login if token is provided (even if empty, but warn if empty)
-if hf_token:
-    login(token=hf_token)
-else:
-    print("Warning: No Hugging Face token provided. Assuming public repo access.")
+# Sources: read(start, end) yields the bytes of [start, end)
+class HttpSource:
+    def __init__(self, url, token):
+        self.url = url
+        self.headers = {'User-Agent': 'ObscyrusDownloader/1.1'}
+        if token:
+            self.headers['Authorization'] = f'Bearer {token}'
+        self.size, self.sha256, self.ranges = self.probe()
 
-# Repository details
-repo_id = "ScriptWizarddd/Obscyrus-8B-ClaudeFT"  # From the provided URL
-filename = "Obscyrus1-8B-ClaudeFT.gguf"  # Assuming this is the file name based on previous code
+    # The Hub answers a HEAD on a resolve URL with a redirect carrying the file's size and LFS oid,
+    # so the first response is read before following it. The token only goes to the original host:
+    # once a redirect leaves it (to the CDN), it is dropped from the headers.
+    def probe(self):
+        class NoRedirect(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args):
+                return None
+        opener = urllib.request.build_opener(NoRedirect)
+        url = self.url
+        host = urllib.parse.urlsplit(url).netloc
+        sha256 = None
+        size = None
+        for _ in range(5):
+            try:
+                response = opener.open(urllib.request.Request(url, headers=self.headers, method='HEAD'), timeout=30)
+            except urllib.error.HTTPError as e:
+                if e.code not in (301, 302, 303, 307, 308):
+                    raise
+                response = e
+            headers = response.headers
+            etag = (headers.get('X-Linked-Etag') or headers.get('ETag') or '').replace('W/', '').strip('"')
+            if sha256 is None and len(etag) == 64 and all(c in '0123456789abcdef' for c in etag.lower()):
+                sha256 = etag.lower()
+            if size is None and headers.get('X-Linked-Size'):
+                size = int(headers['X-Linked-Size'])
+            location = headers.get('Location')
+            if location and response.status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, location)
+                if urllib.parse.urlsplit(url).netloc != host:
+                    self.headers.pop('Authorization', None)
+                continue
+            if size is None and headers.get('Content-Length'):
+                size = int(headers['Content-Length'])
+            ranges = headers.get('Accept-Ranges', '').lower() == 'bytes'
+            self.url = url
+            return size, sha256, ranges
+        raise RuntimeError('Too many redirects')
+
+    def read(self, start, end):
+        headers = dict(self.headers, Range=f'bytes={start}-{end - 1}')
+        with urllib.request.urlopen(urllib.request.Request(self.url, headers=headers), timeout=60) as response:
+            if response.status != 206 and not (start == 0 and end == self.size):
+                raise RuntimeError(f'Server ignored the range request (HTTP {response.status})')
+            while True:
+                data = response.read(read_size)
+                if not data:
+                    return
+                yield data
+
+class MirrorSource:
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.sha256 = None
+        self.ranges = True
+        if os.path.exists(path + '.sha256'):
+            with open(path + '.sha256', 'r') as f:
+                self.sha256 = f.read().split()[0].lower()
+
+    def read(self, start, end):
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while start < end:
+                data = f.read(min(read_size, end - start))
+                if not data:
+                    raise RuntimeError('Mirror file is shorter than expected')
+                start += len(data)
+                yield data
+
+# Checks the fixed header and walks the key/value section, which a truncated or corrupted file fails
+gguf_scalar_formats = {0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d'}
+
+def skip_gguf_value(f, value_type):
+    if value_type in gguf_scalar_formats:
+        size = struct.calcsize(gguf_scalar_formats[value_type])
+        if len(f.read(size)) != size:
+            raise ValueError('GGUF metadata is truncated')
+    elif value_type == 8:
+        length, = struct.unpack('<Q', f.read(8))
+        f.seek(length, os.SEEK_CUR)
+    elif value_type == 9:
+        item_type, count = struct.unpack('<IQ', f.read(12))
+        if item_type in gguf_scalar_formats:
+            f.seek(struct.calcsize(gguf_scalar_formats[item_type]) * count, os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                skip_gguf_value(f, item_type)
+    else:
+        raise ValueError(f'Unknown GGUF value type {value_type}')
+
+def validate_gguf(path, header_only=False):
+    try:
+        check_gguf(path, header_only)
+    except struct.error:
+        raise ValueError('GGUF metadata is truncated')
+
+def check_gguf(path, header_only):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if f.read(4) != b'GGUF':
+            raise ValueError('Not a GGUF file (bad magic)')
+        version, = struct.unpack('<I', f.read(4))
+        if version not in (2, 3):
+            raise ValueError(f'Unsupported GGUF version {version}')
+        tensor_count, kv_count = struct.unpack('<QQ', f.read(16))
+        if header_only:
+            return
+        for _ in range(kv_count):
+            key_length, = struct.unpack('<Q', f.read(8))
+            f.seek(key_length, os.SEEK_CUR)
+            value_type, = struct.unpack('<I', f.read(4))
+            skip_gguf_value(f, value_type)
+            if f.tell() > size:
+                raise ValueError('GGUF metadata runs past the end of the file')
+        if tensor_count == 0:
+            raise ValueError('GGUF file has no tensors')
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n:.0f} B'
+        n /= 1024
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+class Download:
+    def __init__(self, source, dest, workers, expected_sha256):
+        self.source = source
+        self.dest = dest
+        self.part = dest + '.part'
+        self.journal_path = self.part + '.json'
+        self.workers = workers if source.ranges else 1
+        self.size = source.size
+        self.chunk_size = chunk_size if source.ranges else max(1, self.size)
+        self.chunks = max(1, -(-self.size // self.chunk_size))
+        self.sha256 = expected_sha256
+        self.done = set()
+        self.lock = threading.Lock()
+        self.hash_lock = threading.Lock()
+        self.failed = threading.Event()
+        self.hasher = hashlib.sha256()
+        self.hashed = 0  # chunks folded into the hash, in order
+        self.received = 0
+        self.resumed = 0
+
+    def load_journal(self):
+        if not (os.path.exists(self.journal_path) and os.path.exists(self.part)):
+            return
+        with open(self.journal_path, 'r') as f:
+            journal = json.load(f)
+        if (journal.get('size'), journal.get('chunk_size'), journal.get('sha256')) != (self.size, self.chunk_size, self.sha256):
+            print('Partial download is for a different file: starting over')
+            return
+        self.done = set(journal['done'])
+        self.resumed = sum(self.chunk_bounds(i)[1] - self.chunk_bounds(i)[0] for i in self.done)
+        print(f'Resuming: {format_bytes(self.resumed)} already downloaded')
+
+    def save_journal(self):
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': self.size, 'chunk_size': self.chunk_size, 'sha256': self.sha256, 'done': sorted(self.done)}, f)
+        os.replace(tmp_path, self.journal_path)
+
+    def chunk_bounds(self, i):
+        return i * self.chunk_size, min(self.size, (i + 1) * self.chunk_size)
+
+    # Hash the completed chunks that directly follow what is already hashed, reading them back from
+    # the part file (still in the page cache), so the digest is ready when the last range lands
+    def advance_hash(self):
+        with open(self.part, 'rb') as f:
+            while self.hashed in self.done:
+                start, end = self.chunk_bounds(self.hashed)
+                f.seek(start)
+                while start < end:
+                    data = f.read(min(read_size, end - start))
+                    self.hasher.update(data)
+                    start += len(data)
+                self.hashed += 1
+
+    def fetch(self, i):
+        start, end = self.chunk_bounds(i)
+        for attempt in range(chunk_retries):
+            written = 0
+            try:
+                with open(self.part, 'r+b') as f:
+                    f.seek(start)
+                    for data in self.source.read(start, end):
+                        if self.failed.is_set():
+                            return
+                        f.write(data)
+                        written += len(data)
+                        with self.lock:
+                            self.received += len(data)
+                if written != end - start:
+                    raise RuntimeError(f'range {start}-{end} ended after {written} bytes')
+                break
+            except Exception as e:
+                with self.lock:
+                    self.received -= written
+                if attempt == chunk_retries - 1 or self.failed.is_set():
+                    raise
+                delay = 2 ** attempt
+                print(f'\nRange {start}-{end} failed ({e}); retrying in {delay}s')
+                time.sleep(delay)
+        if i == 0:
+            validate_gguf(self.part, header_only=True)
+        with self.lock:
+            self.done.add(i)
+            self.save_journal()
+        with self.hash_lock:
+            self.advance_hash()
+
+    def progress(self, started, stop):
+        while not stop.wait(0.5):
+            self.print_progress(started)
+        self.print_progress(started)
+        print()
+
+    def print_progress(self, started):
+        elapsed = time.time() - started
+        have = self.resumed + self.received
+        rate = self.received / elapsed if elapsed > 0 else 0
+        eta = format_eta((self.size - have) / rate) if rate > 0 else '--:--:--'
+        percent = have / self.size * 100 if self.size else 100
+        sys.stdout.write(f'\r{format_bytes(have)} / {format_bytes(self.size)} ({percent:.1f}%)  {format_bytes(rate)}/s  ETA {eta}   ')
+        sys.stdout.flush()
 
-# Download path: Creates ./GGUFs relative to the script's location
-download_dir = os.path.join(os.path.dirname(__file__), "GGUFs")
-os.makedirs(download_dir, exist_ok=True)
+    def run(self):
+        self.load_journal()
+        if not self.done:
+            with open(self.part, 'wb') as f:
+                f.truncate(self.size)
+            self.save_journal()
+        self.advance_hash()
+        pending = [i for i in range(self.chunks) if i not in self.done]
+        started = time.time()
+        stop = threading.Event()
+        reporter = threading.Thread(target=self.progress, args=(started, stop), daemon=True)
+        reporter.start()
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                # Chunk 0 first so a wrong URL (an HTML error page) fails its header check early
+                futures = [pool.submit(self.fetch, i) for i in pending]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # Stop the ranges in flight; finished ones stay in the journal
+                    self.failed.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            stop.set()
+            reporter.join()
+        elapsed = time.time() - started
+        if self.received:
+            print(f'Downloaded {format_bytes(self.received)} in {elapsed:.1f}s ({format_bytes(self.received / max(elapsed, 1e-9))}/s)')
+        digest = self.hasher.hexdigest()
+        if self.sha256 and digest != self.sha256:
+            # The journal cannot say which range is bad, so the next run starts over
+            os.remove(self.journal_path)
+            raise RuntimeError(f'SHA-256 mismatch: expected {self.sha256}, got {digest}')
+        if not self.sha256:
+            print(f'Warning: the source publishes no SHA-256 to check against (got {digest})')
+        else:
+            print('SHA-256 verified')
+        validate_gguf(self.part)
+        print('GGUF header verified')
+        os.replace(self.part, self.dest)
+        os.remove(self.journal_path)
 
-# Download the file
-local_filepath = hf_hub_download(
-    repo_id=repo_id,
-    filename=filename,
-    local_dir=download_dir,
-    token=hf_token if hf_token else None  # Use token if available
-)
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    dest = os.path.join(args.output_dir, os.path.basename(args.file))
+    if args.mirror:
+        source = MirrorSource(os.path.join(args.mirror, args.file))
+        print(f'Copying {args.file} from {args.mirror}')
+    else:
+        endpoint = args.endpoint.rstrip('/')
+        hf_token = load_token(endpoint)
+        if not hf_token:
+            print("Warning: No Hugging Face token provided. Assuming public repo access.")
+        source = HttpSource(f'{endpoint}/{args.repo}/resolve/main/{args.file}', hf_token)
+        print(f'Downloading {args.file} from {endpoint}/{args.repo}')
+    if source.size is None:
+        sys.exit('The server did not report the file size')
+    expected = (args.sha256 or source.sha256 or '').lower() or None
+    if os.path.exists(dest) and os.path.getsize(dest) == source.size:
+        print(f'Model already present at {dest}; delete it to download again')
+        return
+    print(f'Size: {format_bytes(source.size)}' + (f', SHA-256 {expected}' if expected else ''))
+    try:
+        Download(source, dest, max(1, args.workers), expected).run()
+    except KeyboardInterrupt:
+        sys.exit('\nInterrupted: run again to resume')
+    except Exception as e:
+        sys.exit(f'\nDownload failed: {e}')
+    print(f"Model downloaded to: {dest}")
 
-print(f"Model downloaded to: {local_filepath}")
+if __name__ == '__main__':
+    main()
@@ -32,6 +32,9 @@ packages = [
     {'import_name': 'flask_socketio', 'pip_name': 'flask-socketio'},
     {'import_name': 'llama_cpp', 'pip_name': 'llama-cpp-python'},  # Note: May require build tools like cmake on some systems
     {'import_name': 'huggingface_hub', 'pip_name': 'huggingface-hub'},
+    {'import_name': 'numpy', 'pip_name': 'numpy'},
+    {'import_name': 'eventlet', 'pip_name': 'eventlet'},  # Async serving; the server falls back to Werkzeug without it
+    {'import_name': 'watchdog', 'pip_name': 'watchdog'},  # Workspace change events; the server polls without it
 ]
 
 def is_package_installed(import_name):
@@ -21,6 +21,9 @@ packages = [
     'flask_socketio',
     'llama_cpp',
     'huggingface_hub',
+    'numpy',
+    'eventlet',
+    'watchdog',
 ]
 
 def is_package_installed(import_name):
@@ -1,17 +1,106 @@
-# Obscyrus1.1.py - Updated backend with conversations management, sidebar support, /search command, and codes management
+# Obscyrus1.1.py - Updated backend with conversations management, sidebar support, /search command, codes management and streamed responses
+import sys
+import time
+import _thread
+import argparse
+
+startup_started = time.perf_counter()
+
+# Serving mode.
+# eventlet and gevent serve every Socket.IO connection from one event loop, so a long generation no
+# longer holds a request thread or stalls heartbeats; blocking work is handed to a bounded pool of OS
+# threads through offload(). 'auto' picks whichever is installed and falls back to the threaded
+# Werkzeug development server. Both have to patch the standard library before anything else is
+# imported, which is why the command line is read here.
+def parse_serve_args(argv):
+    parser = argparse.ArgumentParser(description='Obscyrus server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8854)
+    parser.add_argument('--mode', choices=['auto', 'eventlet', 'gevent', 'threading'], default='auto')
+    parser.add_argument('--workers', type=int, default=4, help='OS threads for inference and file I/O in eventlet/gevent mode')
+    parser.add_argument('--inference-workers', type=int, default=0, help='run completions in this many worker processes (0: in this process)')
+    parser.add_argument('--embedding-model', help='GGUF in GGUFs/ that embeds /search chunks (default: "embedding_model" in GGUFs/models.json)')
+    parser.add_argument('--no-browser', action='store_true')
+    return parser.parse_args(argv)
+
+def resolve_async_mode(mode):
+    if mode != 'auto':
+        return mode
+    for candidate in ('eventlet', 'gevent'):
+        try:
+            __import__(candidate)
+            return candidate
+        except ImportError:
+            pass
+    return 'threading'
+
+serve_args = parse_serve_args(sys.argv[1:] if __name__ == '__main__' else [])
+# Kept from before patching, for the sampling profiler which has to run on a real thread
+os_start_thread = _thread.start_new_thread
+os_get_ident = _thread.get_ident
+os_allocate_lock = _thread.allocate_lock
+os_sleep = time.sleep
+async_mode = resolve_async_mode(serve_args.mode) if __name__ == '__main__' else 'threading'
+if async_mode == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+    from eventlet import tpool
+    tpool.set_num_threads(serve_args.workers)
+elif async_mode == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.threadpool import ThreadPool
+    offload_pool = ThreadPool(serve_args.workers)
+
 import os
 import json
+import re
+import math
+import heapq
 import uuid
-import time
+import hashlib
+import mmap
+import struct
+import gzip
+import mimetypes
+import importlib
+import pickle
+import multiprocessing
 import webbrowser
 import shutil
+import itertools
+import threading
+from collections import OrderedDict, deque
+import numpy as np
 from threading import Timer
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, make_response, send_file, abort, g
+from werkzeug.security import safe_join
 from flask_socketio import SocketIO, emit
-from llama_cpp import Llama
 
-# Set paths
-root_dir = '/home/deck/Documents/MockingByrd'
+# Startup timing.
+# Steps up to the server accepting connections are recorded with mark_startup() and logged at boot;
+# the slow work (convo scan, search and vector indexes, llama_cpp, static assets) runs afterwards in
+# warm_start(). llama_cpp loads its shared library on import, so it is only imported when needed.
+startup_timings = []  # (step, seconds)
+startup_last_mark = startup_started
+
+def mark_startup(step):
+    global startup_last_mark
+    now = time.perf_counter()
+    startup_timings.append((step, now - startup_last_mark))
+    startup_last_mark = now
+
+def format_timings(timings):
+    return ', '.join(f'{step} {seconds * 1000:.0f}ms' for step, seconds in timings)
+
+def new_llama(*args, **kwargs):
+    from llama_cpp import Llama
+    return Llama(*args, **kwargs)
+
+mark_startup('imports')
+
+# Set paths (OBSCYRUS_ROOT points the server at another data directory, e.g. for benchmarks)
+root_dir = os.environ.get('OBSCYRUS_ROOT', '/home/deck/Documents/MockingByrd')
 models_dir = os.path.join(root_dir, 'Obscyrus/GGUFs')
 convos_dir = os.path.join(root_dir, 'Obscyrus/Convos')
 codes_dir = os.path.join(root_dir, 'Obscyrus/Codes')
@@ -23,7 +112,8 @@ if not os.path.exists(codes_dir):
 if not os.path.exists(workspace_dir):
     os.makedirs(workspace_dir)
 
-available_models = [f for f in os.listdir(models_dir) if f.endswith('.gguf')]
+def list_models():
+    return sorted(f for f in os.listdir(models_dir) if f.endswith('.gguf'))
 
 # System prompt base (updated for /edit support)
 system_content_base = """
@@ -37,45 +127,1978 @@ If the user message starts with '/edit', edit the provided current code based on
 
 # Globals
 llm = None
-convos = {}  # id: {'name': str, 'messages': list}
-current_convo_id = None
-current_history = []
+current_model = None
+convos = {}  # id: {'name': str, 'created': float, 'updated': float, 'message_count': int}
+
+app = Flask(__name__, static_folder=None)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=async_mode)
+
+# Run a blocking call (llama.cpp, hashing, compression) off the event loop. Only leaf calls that do not
+# touch the server's own locks are offloaded, since those are green locks under eventlet/gevent.
+def offload(fn, *args, **kwargs):
+    if async_mode == 'eventlet':
+        return tpool.execute(fn, *args, **kwargs)
+    if async_mode == 'gevent':
+        return offload_pool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+# Step a blocking iterator (a streamed completion) one item at a time on the pool
+def offload_iter(iterable):
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = offload(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+# Metrics.
+# Histograms and counters for the inference and I/O paths, exposed at /metrics in the Prometheus
+# text format. observe() records a sample, timed() records how long a block took, increment() bumps a
+# counter; labels are keyword arguments. Each completed response also sends a 'stats' event.
+metric_buckets = {
+    'seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+    'tokens': (1, 8, 32, 128, 512, 1024, 2048, 4096, 8192, 16384, 32768),
+    'rate': (1, 2, 5, 10, 20, 40, 80, 160, 320),
+    'ratio': (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1),
+}
+metric_help = {
+    'obscyrus_queue_wait_seconds': ('seconds', 'Time inference jobs waited in the queue'),
+    'obscyrus_prefill_seconds': ('seconds', 'Time from starting a completion to its first token'),
+    'obscyrus_decode_seconds': ('seconds', 'Time from the first token to the end of a completion'),
+    'obscyrus_prompt_tokens': ('tokens', 'Prompt tokens per completion'),
+    'obscyrus_completion_tokens': ('tokens', 'Generated tokens per completion'),
+    'obscyrus_decode_tokens_per_second': ('rate', 'Decode speed per completion'),
+    'obscyrus_draft_acceptance_rate': ('ratio', 'Estimated share of drafted tokens accepted per response'),
+    'obscyrus_model_load_seconds': ('seconds', 'Time to load a model'),
+    'obscyrus_convo_save_seconds': ('seconds', 'Time to write a conversation and update its indexes'),
+    'obscyrus_search_seconds': ('seconds', 'Time to search conversations and code'),
+    'obscyrus_http_request_seconds': ('seconds', 'HTTP request latency by endpoint'),
+    'obscyrus_response_cache_total': (None, 'Response cache lookups by result'),
+    'obscyrus_jobs_rejected_total': (None, 'Jobs rejected because the queue was full'),
+    'obscyrus_worker_restarts_total': (None, 'Inference worker processes restarted after exiting'),
+    'obscyrus_completion_stops_total': (None, 'Completions by why decoding stopped (stop, length, fence, cancelled)'),
+}
+metric_histograms = {}  # (name, labels): {'counts': [int per bucket], 'sum': float, 'count': int}
+metric_counters = {}  # (name, labels): int
+metrics_lock = threading.Lock()
+
+def metric_labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def observe(name, value, **labels):
+    bounds = metric_buckets[metric_help[name][0]]
+    with metrics_lock:
+        histogram = metric_histograms.setdefault((name, metric_labels(labels)), {'counts': [0] * len(bounds), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def increment(name, **labels):
+    with metrics_lock:
+        key = (name, metric_labels(labels))
+        metric_counters[key] = metric_counters.get(key, 0) + 1
+
+class timed:
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        observe(self.name, self.seconds, **self.labels)
 
-app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+# Current values read at scrape time
+def metric_gauges():
+    return [
+        ('obscyrus_queued_jobs', 'Inference jobs waiting in the queue', len(job_queue)),
+        ('obscyrus_resident_models', 'Models loaded in memory', len(model_pool)),
+        ('obscyrus_kv_cache_bytes', 'Bytes of KV snapshots held in RAM', sum(entry['size'] for entry in kv_states.values())),
+        ('obscyrus_response_cache_entries', 'Entries in the response cache', len(response_cache or ())),
+        ('obscyrus_sessions', 'Connected clients', len(sessions)),
+        ('obscyrus_inference_workers_alive', 'Inference worker processes running', sum(worker.process.is_alive() for worker in worker_processes)),
+    ]
+
+def render_metrics():
+    lines = []
+    with metrics_lock:
+        histograms = sorted((key, dict(value, counts=list(value['counts']))) for key, value in metric_histograms.items())
+        counters = sorted(metric_counters.items())
+    for name, help_text, value in metric_gauges():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+    described = set()
+    for (name, labels), value in counters:
+        if name not in described:
+            described.add(name)
+            lines += [f'# HELP {name} {metric_help[name][1]}', f'# TYPE {name} counter']
+        lines.append(f'{name}{format_labels(labels)} {value}')
+    for (name, labels), histogram in histograms:
+        if name not in described:
+            described.add(name)
+            lines += [f'# HELP {name} {metric_help[name][1]}', f'# TYPE {name} histogram']
+        cumulative = 0
+        for bound, bucket_count in zip(metric_buckets[metric_help[name][0]], histogram['counts']):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{format_labels(labels, [("le", str(bound))])} {cumulative}')
+        lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    if request.endpoint and 'request_started' in g:
+        observe('obscyrus_http_request_seconds', time.perf_counter() - g.request_started, endpoint=request.endpoint, status=response.status_code)
+    return response
+
+# Sampling profiler.
+# While running, a plain OS thread (even under eventlet/gevent) snapshots every thread's stack
+# each profiler_interval seconds and counts identical stacks. /api/profiler starts, stops and
+# resets it and returns the counts, or collapsed stacks for flame graph tools with ?format=collapsed.
+# Stacks whose innermost frame is waiting (wait, sleep, select, ...) are dropped unless include_idle.
+profiler_interval = 0.005
+profiler_max_stacks = 20000
+profiler_idle_functions = {'wait', 'sleep', 'select', 'poll', 'epoll', 'accept', 'recv', 'recv_into', 'readinto', '_wait_for_tstate_lock', 'switch', 'get'}
+profiler = {'running': False, 'include_idle': False, 'samples': 0, 'started': None, 'stacks': {}}
+# A real lock: the sampler thread cannot wait on a green one. It is only held for a few dict updates.
+profiler_lock = os_allocate_lock()
+
+def profiler_loop():
+    own_id = os_get_ident()
+    while profiler['running']:
+        keys = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if not profiler['include_idle'] and frame.f_code.co_name in profiler_idle_functions:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            keys.append(';'.join(reversed(stack)))
+        with profiler_lock:
+            profiler['samples'] += 1
+            for key in keys:
+                if key in profiler['stacks'] or len(profiler['stacks']) < profiler_max_stacks:
+                    profiler['stacks'][key] = profiler['stacks'].get(key, 0) + 1
+        os_sleep(profiler_interval)
+
+def start_profiler(interval=None, include_idle=False):
+    global profiler_interval
+    with profiler_lock:
+        if interval:
+            profiler_interval = max(0.001, float(interval))
+        profiler['include_idle'] = bool(include_idle)
+        if profiler['running']:
+            return
+        profiler['running'] = True
+        profiler['started'] = time.time()
+    os_start_thread(profiler_loop, ())
+
+def stop_profiler():
+    with profiler_lock:
+        profiler['running'] = False
+
+def reset_profiler():
+    with profiler_lock:
+        profiler['stacks'] = {}
+        profiler['samples'] = 0
+        profiler['started'] = time.time() if profiler['running'] else None
+
+# Conversation store.
+# Each conversation is an append-only Convos/{id}.jsonl file of records: one per message
+# ({"role": ..., "content": ...}) plus {"name": ...} records for renames. Convos/index.json
+# holds only the metadata (name, created, updated, message_count), so listing needs no
+# message bodies. Messages are read on demand and only the most recently used
+# conversations are kept in memory. Old whole-file {id}.json conversations are
+# converted on startup and moved to Convos/legacy/.
+# Clients keep a copy of the catalog: every change is broadcast as convo_added, convo_updated or
+# convo_removed with a sequence number, and a client that sees a gap fetches the list again.
+convo_index_path = os.path.join(convos_dir, 'index.json')
+legacy_convos_dir = os.path.join(convos_dir, 'legacy')
+convo_message_cache_size = 8
+convo_messages = OrderedDict()  # id: list of messages, most recently used last
+convo_store_lock = threading.RLock()
+convo_catalog_seq = 0
+convo_list_page_size = 50
+convo_list_max_page_size = 500
+convo_message_page_size = 100
+
+def convo_path(id):
+    return os.path.join(convos_dir, f'{id}.jsonl')
+
+def read_convo_file(id):
+    name = None
+    messages = []
+    with open(convo_path(id), 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'name' in record:
+                name = record['name']
+            else:
+                messages.append(record)
+    return name, messages
+
+def write_convo_file(id, name, messages):
+    tmp_path = convo_path(id) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps({'name': name}) + '\n')
+        for msg in messages:
+            f.write(json.dumps(msg) + '\n')
+    os.replace(tmp_path, convo_path(id))
+
+def append_convo_records(id, records):
+    with open(convo_path(id), 'a') as f:
+        f.write(''.join(json.dumps(record) + '\n' for record in records))
+
+def save_convo_index(index):
+    tmp_path = convo_index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, convo_index_path)
 
-# Load conversations from files
 def load_convos():
-    convos = {}
+    if os.path.exists(convo_index_path):
+        with open(convo_index_path, 'r') as f:
+            return json.load(f)
+    return {}
+
+# Bring the index in line with the files on disk. Runs in warm_start, after the server is up.
+def reconcile_convos():
+    with convo_store_lock:
+        changed = reconcile_convo_files()
+        if changed:
+            save_convo_index(convos)
+            # Too many changes to send one by one: clients fetch the list again
+            socketio.emit('convo_catalog_reset', {'seq': next_catalog_seq()})
+
+def reconcile_convo_files():
+    changed = False
     for file in os.listdir(convos_dir):
-        if file.endswith('.json'):
-            with open(os.path.join(convos_dir, file), 'r') as f:
+        path = os.path.join(convos_dir, file)
+        if file.endswith('.json') and file != 'index.json':
+            # Convert a legacy whole-file conversation
+            id = file[:-5]
+            # Keep the conversation's original age rather than the migration time
+            modified = os.path.getmtime(path)
+            with open(path, 'r') as f:
                 data = json.load(f)
-                id = file[:-5]
-                convos[id] = data
-    return convos
+            write_convo_file(id, data['name'], data['messages'])
+            os.makedirs(legacy_convos_dir, exist_ok=True)
+            os.replace(path, os.path.join(legacy_convos_dir, file))
+            convos[id] = {'name': data['name'], 'created': modified, 'updated': modified, 'message_count': len(data['messages'])}
+            changed = True
+        elif file.endswith('.jsonl') and file[:-6] not in convos:
+            # Present on disk but missing from the index (e.g. index.json was lost)
+            id = file[:-6]
+            name, messages = read_convo_file(id)
+            convos[id] = {'name': name or id, 'created': os.path.getmtime(path), 'updated': os.path.getmtime(path), 'message_count': len(messages)}
+            changed = True
+    for id in [id for id in convos if not os.path.exists(convo_path(id))]:
+        del convos[id]
+        convo_messages.pop(id, None)
+        changed = True
+    return changed
+
+def get_convo_messages(id):
+    with convo_store_lock:
+        if id in convo_messages:
+            convo_messages.move_to_end(id)
+            return convo_messages[id]
+        name, messages = read_convo_file(id)
+        convo_messages[id] = messages
+        while len(convo_messages) > convo_message_cache_size:
+            convo_messages.popitem(last=False)
+        return messages
+
+# Save a conversation. persisted_count is how many of the messages are already on disk
+# for this caller; when it matches the stored count only the new messages are appended.
+def save_convo(id, name, messages, persisted_count=0):
+    with convo_store_lock:
+        meta = convos.get(id)
+        now = time.time()
+        added = meta is None
+        if added:
+            write_convo_file(id, name, messages)
+            convos[id] = {'name': name, 'created': now, 'updated': now, 'message_count': len(messages)}
+        elif meta['message_count'] == persisted_count <= len(messages):
+            records = messages[persisted_count:]
+            if name != meta['name']:
+                records = [{'name': name}] + records
+            if records:
+                append_convo_records(id, records)
+            meta.update({'name': name, 'updated': now, 'message_count': len(messages)})
+        else:
+            # Another session saved a different continuation: last save wins
+            write_convo_file(id, name, messages)
+            meta.update({'name': name, 'updated': now, 'message_count': len(messages)})
+        if id in convo_messages:
+            convo_messages[id] = list(messages)
+        save_convo_index(convos)
+        publish_convo('convo_added' if added else 'convo_updated', id)
+
+def rename_convo(id, name):
+    with convo_store_lock:
+        append_convo_records(id, [{'name': name}])
+        convos[id].update({'name': name, 'updated': time.time()})
+        save_convo_index(convos)
+        publish_convo('convo_updated', id)
+
+def delete_convo(id):
+    with convo_store_lock:
+        del convos[id]
+        convo_messages.pop(id, None)
+        os.remove(convo_path(id))
+        save_convo_index(convos)
+        publish_convo('convo_removed', id)
+
+def next_catalog_seq():
+    global convo_catalog_seq
+    with convo_store_lock:
+        convo_catalog_seq += 1
+        return convo_catalog_seq
+
+def convo_entry(id):
+    meta = convos[id]
+    return {'id': id, 'name': meta['name'], 'created': meta['created'], 'updated': meta['updated'], 'message_count': meta['message_count']}
+
+# Called with convo_store_lock held, so sequence numbers go out in the order the changes were made
+def publish_convo(event, id):
+    data = {'seq': next_catalog_seq()}
+    if event == 'convo_removed':
+        data['id'] = id
+    else:
+        data['convo'] = convo_entry(id)
+    socketio.emit(event, data)
+
+# One page of the catalog, newest first by default, with the sequence number it reflects
+def convo_list_page(offset=0, limit=convo_list_page_size, sort='updated'):
+    offset = max(0, offset)
+    limit = max(1, min(limit, convo_list_max_page_size))
+    with convo_store_lock:
+        if sort == 'name':
+            ids = sorted(convos, key=lambda id: convos[id]['name'].lower())
+        else:
+            sort = 'created' if sort == 'created' else 'updated'
+            ids = sorted(convos, key=lambda id: convos[id][sort], reverse=True)
+        return {'convos': [convo_entry(id) for id in ids[offset:offset + limit]], 'total': len(ids),
+                'offset': offset, 'limit': limit, 'sort': sort, 'seq': convo_catalog_seq}
 
 convos = load_convos()
+mark_startup('convo index')
+
+# Search index for /search.
+# An inverted index over conversation messages (and names) ranked with BM25. Only the
+# per-document term counts are persisted, in Convos/.index/search_index.json; postings
+# are rebuilt from them at startup and documents are reconciled against each
+# conversation's 'updated' time. The index is updated incrementally on save, rename
+# and delete, and written back shortly after the last change.
+index_dir = os.path.join(convos_dir, '.index')
+search_index_path = os.path.join(index_dir, 'search_index.json')
+search_top_k = 8
+search_context_token_budget = 2000
+search_snippet_chars = 600
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+search_docs = {}  # doc key: {'convo': id, 'msg': int or None, 'len': int, 'terms': {term: tf}}
+search_postings = {}  # term: {doc key: tf}
+search_convo_docs = {}  # convo id: {'updated': float, 'docs': [doc key]}
+search_total_len = 0
+search_lock = threading.RLock()
+search_flush_timer = None
+search_index_ready = False
+
+def tokenize_text(text):
+    return re.findall(r'[a-z0-9_]+', text.lower())
+
+def add_search_doc(key, convo_id, msg, text):
+    global search_total_len
+    terms = {}
+    words = tokenize_text(text)
+    for word in words:
+        terms[word] = terms.get(word, 0) + 1
+    search_docs[key] = {'convo': convo_id, 'msg': msg, 'len': len(words), 'terms': terms}
+    search_total_len += len(words)
+    for term, tf in terms.items():
+        search_postings.setdefault(term, {})[key] = tf
+    search_convo_docs[convo_id]['docs'].append(key)
+
+def remove_search_doc(key):
+    global search_total_len
+    doc = search_docs.pop(key, None)
+    if doc is None:
+        return
+    search_total_len -= doc['len']
+    for term in doc['terms']:
+        postings = search_postings.get(term)
+        if postings is not None:
+            postings.pop(key, None)
+            if not postings:
+                del search_postings[term]
+
+def index_convo(id):
+    ensure_search_index()
+    with search_lock:
+        unindex_convo(id, flush=False)
+        search_convo_docs[id] = {'updated': convos[id]['updated'], 'docs': []}
+        add_search_doc(f'{id}:name', id, None, convos[id]['name'])
+        for i, msg in enumerate(get_convo_messages(id)):
+            if msg.get('content'):
+                add_search_doc(f'{id}:{i}', id, i, msg['content'])
+    schedule_search_index_flush()
+
+# A rename only replaces the name document
+def index_convo_name(id):
+    ensure_search_index()
+    with search_lock:
+        if id not in search_convo_docs:
+            index_convo(id)
+            return
+        key = f'{id}:name'
+        remove_search_doc(key)
+        search_convo_docs[id]['docs'].remove(key)
+        add_search_doc(key, id, None, convos[id]['name'])
+        search_convo_docs[id]['updated'] = convos[id]['updated']
+    schedule_search_index_flush()
+
+def unindex_convo(id, flush=True):
+    ensure_search_index()
+    with search_lock:
+        entry = search_convo_docs.pop(id, None)
+        if entry:
+            for key in entry['docs']:
+                remove_search_doc(key)
+    if flush:
+        schedule_search_index_flush()
+
+def load_search_index():
+    global search_total_len
+    if os.path.exists(search_index_path):
+        try:
+            with open(search_index_path, 'r') as f:
+                data = json.load(f)
+            for id, entry in data['convos'].items():
+                search_convo_docs[id] = {'updated': entry['updated'], 'docs': []}
+                for key in entry['docs']:
+                    doc = data['docs'][key]
+                    search_docs[key] = doc
+                    search_convo_docs[id]['docs'].append(key)
+                    search_total_len += doc['len']
+                    for term, tf in doc['terms'].items():
+                        search_postings.setdefault(term, {})[key] = tf
+        except Exception:
+            search_docs.clear()
+            search_postings.clear()
+            search_convo_docs.clear()
+            search_total_len = 0
+    # Reconcile with the conversations on disk
+    for id in list(search_convo_docs):
+        if id not in convos:
+            unindex_convo(id)
+    for id in list(convos):
+        if id not in search_convo_docs or search_convo_docs[id]['updated'] != convos[id]['updated']:
+            index_convo(id)
+
+# Load the index on first use; index_convo re-enters while it is loading, which search_lock allows
+def ensure_search_index():
+    global search_index_ready
+    with search_lock:
+        if search_index_ready:
+            return
+        search_index_ready = True
+        load_search_index()
+
+def schedule_search_index_flush():
+    global search_flush_timer
+    with search_lock:
+        if search_flush_timer is None:
+            search_flush_timer = Timer(2.0, flush_search_index)
+            search_flush_timer.daemon = True
+            search_flush_timer.start()
+
+def flush_search_index():
+    global search_flush_timer
+    with search_lock:
+        search_flush_timer = None
+        data = {'convos': search_convo_docs, 'docs': search_docs}
+        os.makedirs(index_dir, exist_ok=True)
+        tmp_path = search_index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, search_index_path)
+
+def search_convos(query, top_k=search_top_k):
+    ensure_search_index()
+    with search_lock:
+        n_docs = len(search_docs)
+        if not n_docs:
+            return []
+        avg_len = search_total_len / n_docs or 1
+        scores = {}
+        for term in set(tokenize_text(query)):
+            postings = search_postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for key, tf in postings.items():
+                doc_len = search_docs[key]['len']
+                scores[key] = scores.get(key, 0) + idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len))
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(search_docs[key]['convo'], search_docs[key]['msg'], score) for key, score in best]
+
+# Cut a window of the text around the first query term
+def make_snippet(text, query):
+    if len(text) <= search_snippet_chars:
+        return text
+    lowered = text.lower()
+    hits = [lowered.find(term) for term in tokenize_text(query) if term in lowered]
+    start = max(0, min(hits) - search_snippet_chars // 4) if hits else 0
+    snippet = text[start:start + search_snippet_chars]
+    return ('...' if start > 0 else '') + snippet + ('...' if start + search_snippet_chars < len(text) else '')
+
+def count_tokens(text):
+    if llm is not None:
+        return len(llm.tokenize(text.encode('utf-8'), add_bos=False))
+    return len(text) // 4
+
+# Semantic index for /search.
+# Messages from Convos/ and files in Codes/ are split into chunks, embedded and kept as
+# rows of a normalized float32 matrix (Convos/.index/vectors.npy, memory-mapped on load)
+# with one metadata entry per row (vectors_meta.json). Queries are a single matrix-vector
+# product. Updates are queued to a background thread; removed rows are blanked and
+# compacted away once they make up a quarter of the matrix.
+# embedding_model is a small GGUF in GGUFs/ used only for embeddings (e.g. a nomic-embed or
+# bge model). Embedding with the chat model would re-embed everything on each model switch
+# and compete with chat for the same weights, so without one semantic search is off and
+# /search ranks with BM25 alone. It is set with --embedding-model or "embedding_model" in
+# GGUFs/models.json. The index is rebuilt only when embedding_model changes.
+def configured_embedding_model():
+    if serve_args.embedding_model:
+        return serve_args.embedding_model
+    path = os.path.join(models_dir, 'models.json')
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f).get('embedding_model')
+    except (OSError, ValueError) as e:
+        print(f'Could not read the embedding model from {path}: {e}')
+        return None
+
+embedding_model = configured_embedding_model()
+embedding_n_ctx = 512
+search_mode = 'hybrid'  # 'bm25', 'semantic' or 'hybrid'
+semantic_chunk_chars = 1000
+code_chunk_lines = 40
+vectors_path = os.path.join(index_dir, 'vectors.npy')
+vectors_meta_path = os.path.join(index_dir, 'vectors_meta.json')
+
+vector_matrix = None  # np.ndarray (rows, dim)
+vector_meta = []  # row: {'source': 'convo' or 'code', 'id': str, 'msg': int, 'start': int, 'end': int} or None
+vector_model = None  # embedding model name the rows were built with
+vector_lock = threading.RLock()
+vectors_ready = False
+embed_llm = None
+embed_llm_name = None
+embed_lock = threading.Lock()
+embed_queue = deque()
+embed_cond = threading.Condition()
+embed_worker_started = False
+
+def get_embed_llm():
+    global embed_llm, embed_llm_name
+    name = embedding_model
+    if name is None:
+        return None
+    if embed_llm is None or embed_llm_name != name:
+        embed_llm = offload(new_llama, os.path.join(models_dir, name), embedding=True, n_ctx=embedding_n_ctx, verbose=False)
+        embed_llm_name = name
+    return embed_llm
+
+def embed_text(text):
+    with embed_lock:
+        model = get_embed_llm()
+        if model is None:
+            return None
+        vector = np.asarray(offload(model.embed, text), dtype=np.float32)
+    if vector.ndim == 2:
+        # Per-token output from models without pooling: mean-pool
+        vector = vector.mean(axis=0)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def chunk_convo(id):
+    chunks = []
+    if id not in convos:
+        return chunks
+    for i, msg in enumerate(get_convo_messages(id)):
+        content = msg.get('content') or ''
+        for start in range(0, len(content), semantic_chunk_chars):
+            chunks.append(({'source': 'convo', 'id': id, 'msg': i, 'start': start, 'end': start + semantic_chunk_chars}, content[start:start + semantic_chunk_chars]))
+    return chunks
+
+def chunk_code(filename):
+    path = os.path.join(codes_dir, filename)
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r', errors='replace') as f:
+        lines = f.readlines()
+    chunks = []
+    for start in range(0, len(lines), code_chunk_lines):
+        text = f'{filename}\n' + ''.join(lines[start:start + code_chunk_lines])
+        chunks.append(({'source': 'code', 'id': filename, 'start': start, 'end': start + code_chunk_lines}, text))
+    return chunks
+
+def remove_vectors(source, id):
+    with vector_lock:
+        for row, meta in enumerate(vector_meta):
+            if meta is not None and meta['source'] == source and meta['id'] == id:
+                vector_meta[row] = None
+                vector_matrix[row] = 0
+
+def add_vectors(chunks):
+    global vector_matrix
+    rows = []
+    metas = []
+    for meta, text in chunks:
+        vector = embed_text(text)
+        if vector is None:
+            return
+        rows.append(vector)
+        metas.append(meta)
+    if not rows:
+        return
+    with vector_lock:
+        new_rows = np.vstack(rows)
+        if vector_matrix is None or vector_matrix.shape[1] != new_rows.shape[1]:
+            vector_matrix = new_rows
+            vector_meta[:] = metas
+        else:
+            vector_matrix = np.vstack([vector_matrix, new_rows])
+            vector_meta.extend(metas)
+
+def compact_vectors():
+    global vector_matrix
+    with vector_lock:
+        live = [row for row, meta in enumerate(vector_meta) if meta is not None]
+        if vector_matrix is None or len(live) > len(vector_meta) * 3 // 4:
+            return
+        vector_matrix = vector_matrix[live] if live else None
+        vector_meta[:] = [vector_meta[row] for row in live]
+
+def save_vectors():
+    with vector_lock:
+        os.makedirs(index_dir, exist_ok=True)
+        if vector_matrix is not None:
+            with open(vectors_path + '.tmp', 'wb') as f:
+                np.save(f, vector_matrix)
+            os.replace(vectors_path + '.tmp', vectors_path)
+        with open(vectors_meta_path + '.tmp', 'w') as f:
+            json.dump({'model': vector_model, 'rows': vector_meta}, f)
+        os.replace(vectors_meta_path + '.tmp', vectors_meta_path)
+
+def load_vectors():
+    global vector_matrix, vector_model
+    if not (os.path.exists(vectors_path) and os.path.exists(vectors_meta_path)):
+        return
+    try:
+        with open(vectors_meta_path, 'r') as f:
+            data = json.load(f)
+        matrix = np.load(vectors_path, mmap_mode='r')
+        if len(matrix) != len(data['rows']):
+            return
+        with vector_lock:
+            # Read-only map; the embedding worker copies it into memory before changing rows
+            vector_matrix = matrix
+            vector_meta[:] = data['rows']
+            vector_model = data['model']
+    except Exception:
+        return
+
+def ensure_vectors():
+    global vectors_ready
+    with vector_lock:
+        if vectors_ready:
+            return
+        vectors_ready = True
+        load_vectors()
+        stale = vector_model != embedding_model
+    # Built with another embedding model (or none yet): re-embed in the background
+    if stale:
+        queue_embedding('rebuild', None)
+
+# Queue a source for (re)embedding in the background
+def queue_embedding(source, id, remove_only=False):
+    global embed_worker_started
+    if embedding_model is None:
+        return
+    with embed_cond:
+        embed_queue.append((source, id, remove_only))
+        if not embed_worker_started:
+            embed_worker_started = True
+            socketio.start_background_task(embedding_worker)
+        embed_cond.notify()
+
+def embedding_worker():
+    global vector_matrix, vector_model
+    while True:
+        with embed_cond:
+            while not embed_queue:
+                embed_cond.wait()
+            source, id, remove_only = embed_queue.popleft()
+        try:
+            ensure_vectors()
+            with vector_lock:
+                if isinstance(vector_matrix, np.memmap):
+                    vector_matrix = np.array(vector_matrix)
+            name = embedding_model
+            if name is None:
+                continue
+            if vector_model != name:
+                # Vectors from another embedding model are not comparable: rebuild everything
+                with vector_lock:
+                    vector_matrix = None
+                    vector_meta.clear()
+                    vector_model = name
+                for convo_id in list(convos):
+                    add_vectors(chunk_convo(convo_id))
+                for filename in os.listdir(codes_dir):
+                    add_vectors(chunk_code(filename))
+            elif source != 'rebuild':
+                remove_vectors(source, id)
+                if not remove_only:
+                    add_vectors(chunk_convo(id) if source == 'convo' else chunk_code(id))
+                compact_vectors()
+            with embed_cond:
+                idle = not embed_queue
+            if idle:
+                save_vectors()
+        except Exception as e:
+            print(f'Embedding update failed for {source} {id}: {e}')
+
+def semantic_search(query, top_k=search_top_k):
+    ensure_vectors()
+    if vector_matrix is None or embedding_model is None or vector_model != embedding_model:
+        return []
+    query_vector = embed_text(query)
+    if query_vector is None:
+        return []
+    with vector_lock:
+        if vector_matrix is None or vector_matrix.shape[1] != query_vector.shape[0]:
+            return []
+        scores = vector_matrix @ query_vector
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [dict(vector_meta[row]) for row in best if vector_meta[row] is not None]
+
+# Reciprocal rank fusion of two ranked hit lists
+def fuse_rankings(*rankings, k=60):
+    scores = {}
+    hits = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking):
+            key = (hit['source'], hit['id'], hit.get('msg'), hit.get('start'))
+            scores[key] = scores.get(key, 0) + 1 / (k + rank + 1)
+            hits[key] = hit
+    return [hits[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+# Ranked conversation and code snippets for the system prompt, trimmed to the token budget
+def build_search_context(query):
+    hits = [{'source': 'convo', 'id': id, 'msg': msg} for id, msg, score in search_convos(query)]
+    if search_mode != 'bm25':
+        semantic_hits = semantic_search(query)
+        hits = semantic_hits if search_mode == 'semantic' else fuse_rankings(hits, semantic_hits)
+    context = ''
+    used = 0
+    seen = set()
+    for hit in hits[:search_top_k]:
+        text = search_hit_text(hit, query)
+        if not text or text in seen:
+            continue
+        seen.add(text)
+        tokens = count_tokens(text)
+        if used + tokens > search_context_token_budget:
+            break
+        context += text
+        used += tokens
+    return context
+
+def search_hit_text(hit, query):
+    if hit['source'] == 'code':
+        path = os.path.join(codes_dir, hit['id'])
+        if not os.path.isfile(path):
+            return ''
+        with open(path, 'r', errors='replace') as f:
+            lines = f.readlines()[hit['start']:hit['end']]
+        return f"From saved code {hit['id']} (lines {hit['start'] + 1}-{hit['start'] + len(lines)}):\n{''.join(lines)}\n"
+    convo = convos.get(hit['id'])
+    if convo is None:
+        return ''
+    messages = get_convo_messages(hit['id'])
+    msg = hit['msg']
+    if msg is None:
+        # Matched on the conversation name: show how it started
+        if not messages:
+            return ''
+        msg = 0
+    if msg >= len(messages):
+        return ''
+    content = messages[msg].get('content', '')
+    if 'start' in hit:
+        content = content[hit['start']:hit['end']]
+    return f"From conversation {convo['name']}: {make_snippet(content, query)}\n"
+
+# Per-conversation KV state cache.
+# Holds llama.cpp state snapshots keyed by conversation id in a RAM LRU bounded by
+# kv_cache_budget_bytes, and persists them as {id}.kv next to the conversation JSON.
+# Restoring a snapshot before a follow-up turn lets llama.cpp reuse the evaluated
+# history prefix, so only the new user message has to be prefilled.
+kv_cache_budget_bytes = 4 * 1024 ** 3
+kv_states = OrderedDict()  # id: {'model': str, 'state': LlamaState, 'size': int}
+kv_states_bytes = 0
+kv_no_state = object()
+kv_active_key = kv_no_state  # conversation whose state is currently loaded in llm
+# Off while llm keeps logits for every position (speculative decoding): save_state() would copy
+# the n_ctx x n_vocab scores array each turn. llama.cpp still reuses the matching token prefix.
+kv_snapshots_enabled = True
+
+def kv_state_path(id):
+    return os.path.join(convos_dir, f'{id}.kv')
+
+def kv_state_size(state):
+    return state.llama_state_size + state.input_ids.nbytes + state.scores.nbytes
+
+def kv_cache_put(key, model, state):
+    global kv_states_bytes
+    kv_cache_drop(key)
+    size = kv_state_size(state)
+    if size > kv_cache_budget_bytes:
+        return
+    kv_states[key] = {'model': model, 'state': state, 'size': size}
+    kv_states_bytes += size
+    while kv_states_bytes > kv_cache_budget_bytes:
+        _, evicted = kv_states.popitem(last=False)
+        kv_states_bytes -= evicted['size']
+
+def kv_cache_drop(key):
+    global kv_states_bytes
+    entry = kv_states.pop(key, None)
+    if entry:
+        kv_states_bytes -= entry['size']
+
+def kv_cache_get(key, model):
+    entry = kv_states.get(key)
+    if entry is None and isinstance(key, str) and os.path.exists(kv_state_path(key)):
+        try:
+            data = offload(read_kv_state_file, kv_state_path(key))
+            kv_cache_put(key, data['model'], data['state'])
+            entry = kv_states.get(key)
+        except Exception:
+            entry = None
+    if entry is None or entry['model'] != model:
+        return None
+    kv_states.move_to_end(key)
+    return entry['state']
+
+def kv_cache_rekey(old_key, new_key):
+    global kv_active_key
+    entry = kv_states.pop(old_key, None)
+    if entry:
+        kv_states[new_key] = entry
+    if kv_active_key == old_key:
+        kv_active_key = new_key
+
+# Snapshots run to hundreds of MB, so pickling and file I/O happen on the offload pool
+def save_kv_state_to_file(id):
+    entry = kv_states.get(id)
+    if entry is None:
+        return
+    offload(write_kv_state_file, kv_state_path(id), {'model': entry['model'], 'state': entry['state']})
+
+def write_kv_state_file(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def read_kv_state_file(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def delete_kv_state_file(id):
+    kv_cache_drop(id)
+    if os.path.exists(kv_state_path(id)):
+        os.remove(kv_state_path(id))
+
+# Shared system prompt prefix, evaluated once per loaded model.
+# Every conversation starts with system_content_base, so a request without its own
+# snapshot starts from this one and only evaluates what follows the static prefix.
+system_prefixes = {}  # model: LlamaState with the system prompt evaluated
+
+def warm_system_prefix():
+    if current_model in system_prefixes or not kv_snapshots_enabled:
+        return
+    offload(llm.create_chat_completion, [{"role": "system", "content": system_content_base}], max_tokens=1)
+    system_prefixes[current_model] = offload(llm.save_state)
+
+# Load the conversation's KV snapshot (or the shared prefix) into llm before generating
+def restore_kv_state(key):
+    global kv_active_key
+    if kv_active_key == key or not kv_snapshots_enabled:
+        kv_active_key = key
+        return
+    state = kv_cache_get(key, current_model)
+    if state is None and current_model in system_prefixes:
+        state = system_prefixes[current_model]
+    if state is not None:
+        offload(llm.load_state, state)
+    kv_active_key = key
+
+# Snapshot llm after generating so the next turn can resume from it
+def snapshot_kv_state(key):
+    global kv_active_key
+    if kv_snapshots_enabled:
+        kv_cache_put(key, current_model, offload(llm.save_state))
+    kv_active_key = key
+
+# Response cache.
+# Completions are cached on disk under Convos/.cache/, keyed by a hash of the model, the system
+# prompt, the history sent with the request and the prompt itself, so asking the same thing in
+# the same context replays the earlier answer without inference. This covers conversation naming
+# too: saving an unchanged conversation again reuses its name. Entries are evicted least recently
+# used once the cache passes response_cache_max_entries or response_cache_max_bytes.
+# With response_cache_near_duplicates, a prompt whose words overlap a cached prompt's by at least
+# response_cache_similarity (same model, system prompt and history) also counts as a hit.
+# A chat request with no_cache set always generates.
+response_cache_dir = os.path.join(convos_dir, '.cache')
+response_cache_index_path = os.path.join(response_cache_dir, 'index.json')
+response_cache_max_entries = 2000
+response_cache_max_bytes = 64 * 1024 * 1024
+response_cache_near_duplicates = False
+response_cache_similarity = 0.9
+response_cache = None  # key: {'context': str, 'terms': [str], 'size': int, 'used': float}, least recently used first
+response_cache_lock = threading.Lock()
+
+def hash_json(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+# (key, context key) for a request; the context covers everything but the prompt
+def response_cache_keys(model, messages):
+    system = messages[0]['content'] if messages and messages[0]['role'] == 'system' else ''
+    history = messages[1 if system else 0:-1]
+    context = hash_json([model, hash_json(system), hash_json(history)])
+    return hash_json([context, messages[-1]['content']]), context
+
+def response_cache_path(key):
+    return os.path.join(response_cache_dir, key + '.json')
+
+def load_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = OrderedDict()
+        if os.path.exists(response_cache_index_path):
+            try:
+                with open(response_cache_index_path, 'r') as f:
+                    entries = json.load(f)
+                for key, entry in sorted(entries.items(), key=lambda item: item[1]['used']):
+                    response_cache[key] = entry
+            except Exception:
+                response_cache.clear()
+    return response_cache
+
+def save_response_cache_index():
+    os.makedirs(response_cache_dir, exist_ok=True)
+    with open(response_cache_index_path + '.tmp', 'w') as f:
+        json.dump(response_cache, f)
+    os.replace(response_cache_index_path + '.tmp', response_cache_index_path)
+
+def find_near_duplicate(context, prompt):
+    terms = set(tokenize_text(prompt))
+    if not terms:
+        return None
+    best, best_score = None, response_cache_similarity
+    for key, entry in response_cache.items():
+        if entry['context'] != context:
+            continue
+        other = set(entry['terms'])
+        score = len(terms & other) / len(terms | other)
+        if score >= best_score:
+            best, best_score = key, score
+    return best
+
+def response_cache_get(model, messages):
+    key, context = response_cache_keys(model, messages)
+    with response_cache_lock:
+        entries = load_response_cache()
+        if key not in entries and response_cache_near_duplicates:
+            key = find_near_duplicate(context, messages[-1]['content'])
+        if key is None or key not in entries:
+            increment('obscyrus_response_cache_total', result='miss')
+            return None
+        increment('obscyrus_response_cache_total', result='hit')
+        try:
+            with open(response_cache_path(key), 'r') as f:
+                response = json.load(f)['response']
+        except Exception:
+            del entries[key]
+            save_response_cache_index()
+            return None
+        entries[key]['used'] = time.time()
+        entries.move_to_end(key)
+        save_response_cache_index()
+        return response
+
+def response_cache_put(model, messages, response):
+    key, context = response_cache_keys(model, messages)
+    record = json.dumps({'model': model, 'prompt': messages[-1]['content'], 'response': response})
+    with response_cache_lock:
+        entries = load_response_cache()
+        os.makedirs(response_cache_dir, exist_ok=True)
+        with open(response_cache_path(key), 'w') as f:
+            f.write(record)
+        entries.pop(key, None)
+        entries[key] = {'context': context, 'terms': sorted(set(tokenize_text(messages[-1]['content']))), 'size': len(record), 'used': time.time()}
+        total = sum(entry['size'] for entry in entries.values())
+        while len(entries) > 1 and (len(entries) > response_cache_max_entries or total > response_cache_max_bytes):
+            evicted, entry = entries.popitem(last=False)
+            total -= entry['size']
+            if os.path.exists(response_cache_path(evicted)):
+                os.remove(response_cache_path(evicted))
+        save_response_cache_index()
+
+# Incremental code-fence parser for streamed responses.
+# Text before the first ``` goes to on_text, the fenced block goes to on_code_token
+# as it arrives (and to on_code once complete), and text after the block goes to on_text.
+class CodeFenceStream:
+    def __init__(self, on_text, on_code_token, on_code, drop_after=False):
+        self.on_text = on_text
+        self.on_code_token = on_code_token
+        self.on_code = on_code
+        # Discard text after the closing fence (decoding stops there)
+        self.drop_after = drop_after
+        self.state = 'explanation'
+        self.buffer = ''
+        self.lang = ''
+        self.code = []
+        self.started_text = False
+        self.started_after = False
+
+    def feed(self, text):
+        self.buffer += text
+        while self.buffer:
+            if self.state == 'explanation':
+                fence = self.buffer.find('```')
+                if fence != -1:
+                    self._emit_text(self.buffer[:fence])
+                    self.buffer = self.buffer[fence + 3:]
+                    self.state = 'lang'
+                    continue
+                # Hold back trailing backticks that may be the start of a fence
+                keep = len(self.buffer) - len(self.buffer.rstrip('`'))
+                self._emit_text(self.buffer[:len(self.buffer) - keep])
+                self.buffer = self.buffer[len(self.buffer) - keep:]
+                return
+            elif self.state == 'after':
+                if not self.drop_after:
+                    self._emit_text(self.buffer)
+                self.buffer = ''
+                return
+            elif self.state == 'lang':
+                end_lang = self.buffer.find('\n')
+                if end_lang == -1:
+                    return
+                self.lang = self.buffer[:end_lang].strip()
+                self.buffer = self.buffer[end_lang + 1:]
+                self.state = 'code'
+            elif self.state == 'code':
+                fence = self.buffer.find('```')
+                if fence != -1:
+                    self._emit_code(self.buffer[:fence])
+                    self.buffer = self.buffer[fence + 3:]
+                    self._close_code()
+                    self.state = 'after'
+                    continue
+                keep = len(self.buffer) - len(self.buffer.rstrip('`'))
+                self._emit_code(self.buffer[:len(self.buffer) - keep])
+                self.buffer = self.buffer[len(self.buffer) - keep:]
+                return
+
+    def finish(self):
+        if self.state == 'lang':
+            # Opening fence without a newline: treat the rest as trailing text
+            self.state = 'after'
+        if self.state == 'code':
+            self._emit_code(self.buffer)
+            self.buffer = ''
+            self._close_code()
+        elif self.buffer:
+            self._emit_text(self.buffer)
+            self.buffer = ''
+
+    def _emit_text(self, text):
+        if not text:
+            return
+        if self.state == 'after':
+            if not self.started_after:
+                text = text.lstrip()
+                if not text:
+                    return
+                self.started_after = True
+                text = '\n\n' + text
+        elif not self.started_text:
+            text = text.lstrip()
+            if not text:
+                return
+            self.started_text = True
+        self.on_text(text)
+
+    def _emit_code(self, text):
+        if not text:
+            return
+        self.code.append(text)
+        self.on_code_token(text, self.lang)
+
+    def _close_code(self):
+        code = ''.join(self.code).strip()
+        if code:
+            self.on_code(code, self.lang)
+
+# Workspace index.
+# An in-memory record of every workspace file (size, mtime, language, and the SHA-256
+# once it has been needed) plus the directory tree, so listings never walk the disk.
+# Uploads and syncs update it directly. Changes made outside the server are picked up
+# from watchdog's file system events (inotify and friends) when the watchdog module is
+# installed; the paths it reports are re-statted every workspace_watch_interval seconds.
+# Without it the whole tree is re-statted every workspace_poll_interval seconds, walking
+# the disk on the offload pool. Each directory has a version that changes with its
+# children and serves as its ETag.
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+workspace_watch_interval = 0.5
+workspace_poll_interval = 5.0
+workspace_changed_paths = set()  # rel paths reported by watchdog since the last refresh
+workspace_tree_page_size = 500
+workspace_index = {}  # rel path: {'size': int, 'mtime_ns': int, 'lang': str, 'sha256': str or None}
+workspace_tree = {'': {}}  # dir rel path: {child name: 'dir' or 'file'}
+workspace_dir_versions = {}  # dir rel path: int
+workspace_index_epoch = uuid.uuid4().hex[:8]  # keeps ETags from a previous run from matching
+workspace_lock = threading.RLock()
+workspace_index_ready = False
+
+def file_lang(filename):
+    return filename.split('.')[-1] if '.' in filename else 'text'
+
+def bump_dir_version(dir_path):
+    workspace_dir_versions[dir_path] = workspace_dir_versions.get(dir_path, 0) + 1
+
+def index_workspace_file(rel_path, stat, sha256=None):
+    with workspace_lock:
+        previous = workspace_index.get(rel_path)
+        if code_index_started and (previous is None or previous['size'] != stat.st_size or previous['mtime_ns'] != stat.st_mtime_ns):
+            queue_code_index('workspace', rel_path)
+        workspace_index[rel_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'lang': file_lang(rel_path), 'sha256': sha256}
+        parts = rel_path.split('/')
+        parent = ''
+        for i, name in enumerate(parts):
+            kind = 'file' if i == len(parts) - 1 else 'dir'
+            if workspace_tree[parent].get(name) != kind:
+                workspace_tree[parent][name] = kind
+                bump_dir_version(parent)
+                if kind == 'dir':
+                    workspace_tree.setdefault(parent + name + '/', {})
+            parent += name + '/' if kind == 'dir' else ''
+        # Size and mtime are part of the listing, so the parent changes either way
+        bump_dir_version(parent)
+
+def unindex_workspace_file(rel_path):
+    with workspace_lock:
+        if workspace_index.pop(rel_path, None) is None:
+            return
+        if code_index_started:
+            queue_code_index('workspace', rel_path, remove_only=True)
+        parent, _, name = rel_path.rpartition('/')
+        parent = parent + '/' if parent else ''
+        workspace_tree[parent].pop(name, None)
+        bump_dir_version(parent)
+        # Drop directories that are now empty
+        while parent and not workspace_tree[parent]:
+            del workspace_tree[parent]
+            workspace_dir_versions.pop(parent, None)
+            grandparent, _, dir_name = parent[:-1].rpartition('/')
+            grandparent = grandparent + '/' if grandparent else ''
+            workspace_tree[grandparent].pop(dir_name, None)
+            bump_dir_version(grandparent)
+            parent = grandparent
+
+def clear_workspace_index():
+    with workspace_lock:
+        workspace_index.clear()
+        if code_index_started:
+            queue_code_index('workspace', None, remove_only=True)
+        workspace_tree.clear()
+        workspace_tree[''] = {}
+        for dir_path in workspace_dir_versions:
+            bump_dir_version(dir_path)
+        bump_dir_version('')
+
+# Size and mtime of every file under a workspace subdirectory ('' for all of it).
+# Touches only the disk, so it runs on the offload pool.
+def walk_workspace_blocking(prefix=''):
+    found = {}
+    for root, dirs, fns in os.walk(os.path.join(workspace_dir, prefix)):
+        for fn in fns:
+            if fn.endswith(upload_tmp_suffix):
+                continue
+            path = os.path.join(root, fn)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found[os.path.relpath(path, workspace_dir).replace(os.sep, '/')] = stat
+    return found
+
+# Bring the index in line with the disk under prefix; cheap when nothing changed
+def scan_workspace(prefix=''):
+    found = offload(walk_workspace_blocking, prefix)
+    with workspace_lock:
+        known = {rel_path: (entry['size'], entry['mtime_ns']) for rel_path, entry in workspace_index.items() if rel_path.startswith(prefix)}
+    for rel_path, stat in found.items():
+        if known.get(rel_path) != (stat.st_size, stat.st_mtime_ns):
+            index_workspace_file(rel_path, stat)
+    for rel_path in known:
+        if rel_path not in found:
+            unindex_workspace_file(rel_path)
+
+# Re-stat the paths watchdog reported: a file is re-indexed, a directory rescanned,
+# and anything that is gone is dropped along with whatever was indexed under it
+def refresh_workspace_paths(rel_paths):
+    for rel_path in rel_paths:
+        path = os.path.join(workspace_dir, rel_path)
+        if os.path.isdir(path):
+            scan_workspace(rel_path + '/')
+        elif os.path.isfile(path):
+            if rel_path.endswith(upload_tmp_suffix):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            with workspace_lock:
+                entry = workspace_index.get(rel_path)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                index_workspace_file(rel_path, stat)
+        else:
+            with workspace_lock:
+                gone = [known for known in workspace_index if known == rel_path or known.startswith(rel_path + '/')]
+            for known in gone:
+                unindex_workspace_file(known)
+
+class WorkspaceEventHandler(FileSystemEventHandler):
+    def on_any_event(self, event):
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        with workspace_lock:
+            for path in paths:
+                if path:
+                    rel_path = os.path.relpath(os.fsdecode(path), workspace_dir).replace(os.sep, '/')
+                    if rel_path != '.' and not rel_path.startswith('..'):
+                        workspace_changed_paths.add(rel_path)
+
+# Started before the first scan, so nothing changed in between goes unnoticed
+def start_workspace_observer():
+    if Observer is None:
+        return None
+    try:
+        observer = Observer()
+        observer.schedule(WorkspaceEventHandler(), workspace_dir, recursive=True)
+        observer.start()
+        return observer
+    except Exception as e:
+        print(f'Workspace file events unavailable ({e}); polling instead')
+        return None
+
+def workspace_watcher(observer):
+    while True:
+        socketio.sleep(workspace_watch_interval if observer is not None else workspace_poll_interval)
+        try:
+            if observer is None:
+                scan_workspace()
+                continue
+            with workspace_lock:
+                changed = sorted(workspace_changed_paths)
+                workspace_changed_paths.clear()
+            refresh_workspace_paths(changed)
+        except Exception as e:
+            print(f'Workspace scan failed: {e}')
+
+def ensure_workspace_index():
+    global workspace_index_ready
+    with workspace_lock:
+        if workspace_index_ready:
+            return
+        workspace_index_ready = True
+        observer = start_workspace_observer()
+        scan_workspace()
+    socketio.start_background_task(workspace_watcher, observer)
+
+def list_workspace_files():
+    ensure_workspace_index()
+    with workspace_lock:
+        return sorted(workspace_index)
+
+# One page of a directory's children, folders first
+def workspace_tree_page(dir_path, offset=0, limit=workspace_tree_page_size):
+    ensure_workspace_index()
+    with workspace_lock:
+        children = workspace_tree.get(dir_path)
+        if children is None:
+            return None
+        names = sorted(children, key=lambda name: (children[name] != 'dir', name.lower()))
+        entries = []
+        for name in names[offset:offset + limit]:
+            if children[name] == 'dir':
+                entries.append({'name': name, 'type': 'dir', 'path': dir_path + name + '/'})
+            else:
+                entry = workspace_index[dir_path + name]
+                entries.append({'name': name, 'type': 'file', 'path': dir_path + name, 'size': entry['size'], 'lang': entry['lang']})
+        return {'path': dir_path, 'entries': entries, 'offset': offset, 'total': len(names), 'version': workspace_dir_versions.get(dir_path, 0)}
+
+# Workspace sync.
+# The client sends a manifest of {path, size, sha256}; the server answers with the paths
+# it is missing or holds a different version of, deletes paths that are no longer in the
+# manifest, and the client then uploads just those files one by one with PUT requests
+# that are streamed to disk in chunks. Hashes are kept in the workspace index.
+upload_chunk_bytes = 1024 * 1024
+upload_tmp_suffix = '.obscyrus-upload'
+
+# Resolve a client-supplied relative path, refusing anything outside the workspace
+def safe_workspace_path(rel_path):
+    full_path = os.path.realpath(os.path.join(workspace_dir, rel_path))
+    root = os.path.realpath(workspace_dir)
+    if not rel_path or os.path.isabs(rel_path) or not full_path.startswith(root + os.sep):
+        raise ValueError(f'Invalid workspace path: {rel_path}')
+    return full_path
+
+def hash_file(path):
+    return offload(hash_file_blocking, path)
+
+def hash_file_blocking(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(upload_chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def workspace_file_hash(rel_path):
+    path = safe_workspace_path(rel_path)
+    stat = os.stat(path)
+    with workspace_lock:
+        cached = workspace_index.get(rel_path)
+        if cached and cached['sha256'] and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+    sha256 = hash_file(path)
+    index_workspace_file(rel_path, stat, sha256)
+    return sha256
+
+def remove_workspace_file(rel_path):
+    path = safe_workspace_path(rel_path)
+    os.remove(path)
+    unindex_workspace_file(rel_path)
+    # Prune directories left empty
+    parent = os.path.dirname(path)
+    while parent != os.path.realpath(workspace_dir) and not os.listdir(parent):
+        os.rmdir(parent)
+        parent = os.path.dirname(parent)
+
+# Copy a stream to the workspace in chunks, hashing as it goes; returns (bytes, sha256)
+# The upload lands in a temp file and only replaces the existing file once it is complete
+# and matches the expected checksum, if one was given
+def write_workspace_stream(rel_path, stream, expected=None):
+    path = safe_workspace_path(rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.sha256()
+    written = 0
+    tmp_path = path + upload_tmp_suffix
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(upload_chunk_bytes), b''):
+                digest.update(chunk)
+                f.write(chunk)
+                written += len(chunk)
+        if expected and expected != digest.hexdigest():
+            raise ValueError(f'Checksum mismatch for {rel_path}')
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    index_workspace_file(rel_path, os.stat(path), digest.hexdigest())
+    return written, digest.hexdigest()
+
+# File reads for the code editor.
+# Small text files are served whole from an LRU cache keyed by mtime, so flipping between
+# tabs does not reread them. Larger files are read through mmap in line windows
+# (start_line/max_lines) or byte windows (offset/length), with line offsets indexed
+# once per file version. Binary files only get their metadata back.
+max_inline_file_bytes = 2 * 1024 * 1024
+default_window_lines = 2000
+binary_sniff_bytes = 8192
+file_cache_max_bytes = 64 * 1024 * 1024
+file_cache = OrderedDict()  # path: {'mtime_ns': int, 'size': int, 'text': str or None, 'line_offsets': list or None}
+file_cache_bytes = 0
+file_cache_lock = threading.Lock()
+
+def is_binary_file(path):
+    with open(path, 'rb') as f:
+        head = f.read(binary_sniff_bytes)
+    if b'\0' in head:
+        return True
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sample is still text
+        return e.start < len(head) - 3
+    return False
+
+def cached_file_entry(path, stat):
+    global file_cache_bytes
+    with file_cache_lock:
+        entry = file_cache.get(path)
+        if entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            file_cache.move_to_end(path)
+            return entry
+        if entry:
+            file_cache_bytes -= entry['cost']
+        entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'text': None, 'line_offsets': None, 'cost': 0}
+        file_cache[path] = entry
+        return entry
+
+def charge_file_cache(entry, cost):
+    global file_cache_bytes
+    with file_cache_lock:
+        entry['cost'] += cost
+        file_cache_bytes += cost
+        while file_cache_bytes > file_cache_max_bytes and len(file_cache) > 1:
+            _, evicted = file_cache.popitem(last=False)
+            file_cache_bytes -= evicted['cost']
+
+# Byte offset of the start of every line, found with mmap without decoding the file
+def line_offsets(path, entry):
+    if entry['line_offsets'] is None:
+        offsets = [0]
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = mm.find(b'\n')
+            while position != -1:
+                offsets.append(position + 1)
+                position = mm.find(b'\n', position + 1)
+        if offsets[-1] == entry['size'] and len(offsets) > 1:
+            offsets.pop()
+        entry['line_offsets'] = offsets
+        charge_file_cache(entry, len(offsets) * 8)
+    return entry['line_offsets']
+
+def read_byte_range(path, start, end):
+    if end <= start:
+        return ''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[start:end].decode('utf-8', errors='replace')
+
+# Build the JSON body for a code read; options come from the request
+# The window fields of a file read request, as integers; ValueError (a 400) for anything else
+def parse_window_options(data):
+    options = {}
+    for name in ('start_line', 'max_lines', 'offset', 'length'):
+        value = data.get(name)
+        if value is None or value == '':
+            continue
+        if isinstance(value, bool):
+            raise ValueError(f'{name} must be an integer')
+        try:
+            options[name] = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{name} must be an integer')
+    return options
+
+def read_code_file(path, filename, options):
+    stat = os.stat(path)
+    result = {'lang': file_lang(filename), 'size': stat.st_size}
+    if stat.st_size and is_binary_file(path):
+        result.update({'binary': True, 'code': ''})
+        return result
+    entry = cached_file_entry(path, stat)
+    if 'offset' in options:
+        offset = max(0, options['offset'])
+        length = max(1, options.get('length') or max_inline_file_bytes)
+        end = min(stat.st_size, offset + length)
+        result.update({'code': read_byte_range(path, offset, end), 'offset': offset, 'end_offset': end, 'truncated': offset > 0 or end < stat.st_size})
+        return result
+    if 'start_line' not in options and stat.st_size <= max_inline_file_bytes:
+        if entry['text'] is None:
+            with open(path, 'r', errors='replace') as f:
+                entry['text'] = f.read()
+            charge_file_cache(entry, stat.st_size)
+        result['code'] = entry['text']
+        return result
+    if stat.st_size == 0:
+        result['code'] = ''
+        return result
+    offsets = line_offsets(path, entry)
+    start_line = max(1, options.get('start_line') or 1)
+    max_lines = max(1, options.get('max_lines') or default_window_lines)
+    first = min(start_line - 1, len(offsets))
+    last = min(first + max_lines, len(offsets))
+    start = offsets[first] if first < len(offsets) else stat.st_size
+    end = offsets[last] if last < len(offsets) else stat.st_size
+    result.update({
+        'code': read_byte_range(path, start, end),
+        'start_line': first + 1,
+        'end_line': last,
+        'total_lines': len(offsets),
+        'truncated': first > 0 or last < len(offsets),
+    })
+    return result
+
+# Code search index over Workspace/ and Codes/.
+# A trigram index narrows a query down to the files that can contain it, which are then
+# scanned for matching lines; a symbol table maps Python/JS definitions and HTML ids to
+# their lines. Files are (re)indexed on a background thread whenever the workspace
+# index or the saved codes change. Chat prompts that name a known symbol get the code
+# around its definition attached.
+code_index_max_file_bytes = 1024 * 1024
+code_search_default_limit = 50
+code_context_token_budget = 1500
+code_context_lines = 12
+code_symbol_patterns = {
+    'py': re.compile(r'^[ \t]*(?:async[ \t]+)?(def|class)[ \t]+([A-Za-z_]\w*)', re.M),
+    'js': re.compile(r'^[ \t]*(?:export[ \t]+)?(?:async[ \t]+)?(function|class|const|let|var)[ \t]+([A-Za-z_$][\w$]*)', re.M),
+    'html': re.compile(r'<[a-zA-Z][^>]*?\b(id)=["\']([^"\']+)["\']|^[ \t]*(?:async[ \t]+)?(function|class|const|let|var)[ \t]+([A-Za-z_$][\w$]*)', re.M),
+}
+code_symbol_langs = {'py': 'py', 'js': 'js', 'mjs': 'js', 'ts': 'js', 'jsx': 'js', 'tsx': 'js', 'html': 'html', 'htm': 'html'}
+
+code_docs = {}  # doc id: {'source': 'workspace' or 'codes', 'path': str, 'trigrams': set, 'symbols': list}
+code_doc_ids = {}  # (source, path): doc id
+code_trigrams = {}  # trigram: set of doc ids
+code_symbols = {}  # lowercased symbol name: [(doc id, line, kind, name)]
+code_doc_seq = itertools.count()
+code_index_lock = threading.RLock()
+code_index_queue = deque()
+code_index_cond = threading.Condition()
+code_index_started = False
+code_index_active = False  # True while the worker is handling a queued entry
+
+def code_source_path(source, path):
+    return safe_workspace_path(path) if source == 'workspace' else os.path.join(codes_dir, path)
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def extract_symbols(path, text):
+    pattern = code_symbol_patterns.get(code_symbol_langs.get(file_lang(path).lower()))
+    symbols = []
+    if pattern is None:
+        return symbols
+    # Count newlines only between consecutive matches, not from the top of the file each time
+    line = 1
+    position = 0
+    for match in pattern.finditer(text):
+        groups = [group for group in match.groups() if group]
+        line += text.count('\n', position, match.start())
+        position = match.start()
+        symbols.append((line, groups[0], groups[1]))
+    return symbols
 
-# Save conversation to file
-def save_convo_to_file(id, name, messages):
-    with open(os.path.join(convos_dir, f'{id}.json'), 'w') as f:
-        json.dump({'name': name, 'messages': messages}, f)
+def unindex_code_doc(source, path):
+    with code_index_lock:
+        doc_id = code_doc_ids.pop((source, path), None)
+        if doc_id is None:
+            return
+        doc = code_docs.pop(doc_id)
+        for trigram in doc['trigrams']:
+            postings = code_trigrams.get(trigram)
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    del code_trigrams[trigram]
+        for line, kind, name in doc['symbols']:
+            entries = [entry for entry in code_symbols.get(name.lower(), []) if entry[0] != doc_id]
+            if entries:
+                code_symbols[name.lower()] = entries
+            else:
+                code_symbols.pop(name.lower(), None)
+
+# Read a file and compute its trigrams and symbols; None when it is not indexable
+def read_code_doc(full_path, path):
+    if not os.path.isfile(full_path) or os.path.getsize(full_path) > code_index_max_file_bytes or is_binary_file(full_path):
+        return None
+    with open(full_path, 'r', errors='replace') as f:
+        text = f.read()
+    return trigrams(text.lower()), extract_symbols(path, text)
+
+def index_code_doc(source, path):
+    unindex_code_doc(source, path)
+    parsed = offload(read_code_doc, code_source_path(source, path), path)
+    if parsed is None:
+        return
+    doc_trigrams, symbols = parsed
+    with code_index_lock:
+        doc_id = next(code_doc_seq)
+        code_docs[doc_id] = {'source': source, 'path': path, 'trigrams': doc_trigrams, 'symbols': symbols}
+        code_doc_ids[(source, path)] = doc_id
+        for trigram in doc_trigrams:
+            code_trigrams.setdefault(trigram, set()).add(doc_id)
+        for line, kind, name in symbols:
+            code_symbols.setdefault(name.lower(), []).append((doc_id, line, kind, name))
+
+# Queue a file for (re)indexing; path None with source 'workspace' drops all workspace files
+def queue_code_index(source, path, remove_only=False):
+    global code_index_started
+    with code_index_cond:
+        code_index_queue.append((source, path, remove_only))
+        if not code_index_started:
+            code_index_started = True
+            socketio.start_background_task(code_index_worker)
+            # First start: index everything already on disk
+            for filename in os.listdir(codes_dir):
+                code_index_queue.append(('codes', filename, False))
+            for rel_path in list(workspace_index):
+                code_index_queue.append(('workspace', rel_path, False))
+        code_index_cond.notify()
+
+def code_index_worker():
+    global code_index_active
+    while True:
+        with code_index_cond:
+            code_index_active = False
+            while not code_index_queue:
+                code_index_cond.wait()
+            source, path, remove_only = code_index_queue.popleft()
+            code_index_active = True
+        try:
+            if path is None:
+                with code_index_lock:
+                    for key in [key for key in code_doc_ids if key[0] == source]:
+                        unindex_code_doc(*key)
+            elif remove_only:
+                unindex_code_doc(source, path)
+            else:
+                index_code_doc(source, path)
+        except Exception as e:
+            print(f'Code index update failed for {source} {path}: {e}')
+
+def ensure_code_index():
+    ensure_workspace_index()
+    if not code_index_started:
+        queue_code_index('codes', None, remove_only=True)
+
+# True until the worker has caught up with every queued file
+def code_index_building():
+    with code_index_cond:
+        return not code_index_started or bool(code_index_queue) or code_index_active
+
+def search_code(query, limit=code_search_default_limit):
+    ensure_code_index()
+    lowered = query.lower()
+    hits = []
+    with code_index_lock:
+        for doc_id, line, kind, name in code_symbols.get(lowered, []):
+            doc = code_docs[doc_id]
+            hits.append({'source': doc['source'], 'path': doc['path'], 'line': line, 'symbol': name, 'kind': kind, 'score': 100 + (name == query)})
+        if len(lowered) >= 3:
+            query_trigrams = trigrams(lowered)
+            candidates = set.intersection(*(code_trigrams.get(trigram, set()) for trigram in query_trigrams))
+        else:
+            candidates = set(code_docs)
+        candidates = [(doc_id, code_docs[doc_id]['source'], code_docs[doc_id]['path']) for doc_id in candidates]
+    for doc_id, source, path in candidates:
+        try:
+            with open(code_source_path(source, path), 'r', errors='replace') as f:
+                for number, text in enumerate(f, 1):
+                    position = text.lower().find(lowered)
+                    if position == -1:
+                        continue
+                    score = 10 + (query in text) + (lowered in path.lower())
+                    hits.append({'source': source, 'path': path, 'line': number, 'text': text.rstrip('\n')[:300], 'score': score})
+        except (OSError, ValueError):
+            continue
+    hits.sort(key=lambda hit: (-hit['score'], hit['path'], hit['line']))
+    return hits[:limit]
+
+# Code around the definitions of workspace symbols named in the prompt
+def build_code_context(prompt):
+    ensure_code_index()
+    if not code_symbols:
+        return ''
+    context = ''
+    used = 0
+    seen = set()
+    for word in set(re.findall(r'[A-Za-z_$][\w$]{3,}', prompt)):
+        with code_index_lock:
+            entries = [(code_docs[doc_id]['source'], code_docs[doc_id]['path'], line) for doc_id, line, kind, name in code_symbols.get(word.lower(), []) if name == word]
+        for source, path, line in entries:
+            if (source, path, line) in seen:
+                continue
+            seen.add((source, path, line))
+            try:
+                with open(code_source_path(source, path), 'r', errors='replace') as f:
+                    lines = f.readlines()
+            except (OSError, ValueError):
+                continue
+            snippet = ''.join(lines[line - 1:line - 1 + code_context_lines])
+            text = f"{path} (line {line}):\n```\n{snippet}```\n"
+            tokens = count_tokens(text)
+            if used + tokens > code_context_token_budget:
+                return context
+            context += text
+            used += tokens
+    return context
+
+# Static asset pipeline.
+# build_static_assets() writes gzip (and brotli, when the brotli module is installed)
+# variants of compressible files to static/.compressed/ along with a manifest of content
+# hashes; it only redoes files that changed and runs in the background at startup.
+# Requests are answered with the best variant the client accepts, a content-hash ETag,
+# and small files are kept in memory. URLs under /static/_v/<tag>/ carry the fingerprint
+# of the whole asset tree, so they are served as immutable; the frontend HTML is
+# rewritten to use them.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+static_dir = os.path.join(app_dir, 'static')
+compressed_dir = os.path.join(static_dir, '.compressed')
+static_manifest_path = os.path.join(compressed_dir, 'manifest.json')
+frontend_path = os.path.join(app_dir, 'ObscyrusFE1.1.html')
+compressible_extensions = {'.js', '.css', '.html', '.json', '.svg', '.ttf', '.map', '.txt', '.md'}
+compress_min_bytes = 1024
+static_memory_max_file_bytes = 256 * 1024
+static_memory_max_bytes = 32 * 1024 * 1024
+static_manifest = {}  # rel path: {'etag': str, 'size': int, 'mtime_ns': int, 'gzip': etag or None, 'br': etag or None}
+static_tag = 'dev'
+static_memory = OrderedDict()  # (rel path, encoding): bytes
+static_memory_bytes = 0
+static_lock = threading.Lock()
+frontend_cache = {}  # 'mtime_ns', 'etag', 'body', 'gzip'
+
+def static_entry(rel_path, path):
+    stat = os.stat(path)
+    with static_lock:
+        entry = static_manifest.get(rel_path)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry
+    entry = {'etag': hash_file(path)[:16], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'gzip': None, 'br': None}
+    with static_lock:
+        static_manifest[rel_path] = entry
+    return entry
+
+def variant_path(rel_path, encoding):
+    return os.path.join(compressed_dir, rel_path + ('.gz' if encoding == 'gzip' else '.br'))
+
+def build_static_assets():
+    global static_tag
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != compressed_dir]
+        for fn in files:
+            path = os.path.join(root, fn)
+            rel_path = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            entry = static_entry(rel_path, path)
+            if os.path.splitext(fn)[1].lower() not in compressible_extensions or entry['size'] < compress_min_bytes:
+                continue
+            encodings = ['gzip'] + (['br'] if brotli is not None else [])
+            if all(entry[encoding] == entry['etag'] for encoding in encodings):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding in encodings:
+                if entry[encoding] == entry['etag']:
+                    continue
+                compressed = offload(gzip.compress, data, 9) if encoding == 'gzip' else offload(brotli.compress, data, quality=9)
+                if len(compressed) >= len(data):
+                    continue
+                out_path = variant_path(rel_path, encoding)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                with open(out_path, 'wb') as f:
+                    f.write(compressed)
+                entry[encoding] = entry['etag']
+    with static_lock:
+        os.makedirs(compressed_dir, exist_ok=True)
+        with open(static_manifest_path + '.tmp', 'w') as f:
+            json.dump(static_manifest, f)
+        os.replace(static_manifest_path + '.tmp', static_manifest_path)
+        static_tag = compute_static_tag()
+
+def compute_static_tag():
+    digest = hashlib.sha256()
+    for rel_path in sorted(static_manifest):
+        digest.update(f'{rel_path}:{static_manifest[rel_path]["etag"]}\n'.encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+def load_static_manifest():
+    global static_tag
+    if os.path.exists(static_manifest_path):
+        try:
+            with open(static_manifest_path, 'r') as f:
+                static_manifest.update(json.load(f))
+            static_tag = compute_static_tag()
+        except Exception:
+            static_manifest.clear()
+
+def accepted_encoding(entry):
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if entry.get(encoding) == entry['etag'] and accepted[encoding]:
+            return encoding
+    return None
+
+def remember_static(key, body):
+    global static_memory_bytes
+    with static_lock:
+        static_memory[key] = body
+        static_memory_bytes += len(body)
+        while static_memory_bytes > static_memory_max_bytes:
+            _, evicted = static_memory.popitem(last=False)
+            static_memory_bytes -= len(evicted)
+
+def serve_static_file(rel_path, immutable=False):
+    path = safe_join(static_dir, rel_path)
+    if path is None or not os.path.isfile(path) or path.startswith(compressed_dir + os.sep):
+        abort(404)
+    entry = static_entry(rel_path, path)
+    encoding = accepted_encoding(entry)
+    etag = entry['etag'] + (f'-{encoding}' if encoding else '')
+    mimetype = mimetypes.guess_type(rel_path)[0] or 'application/octet-stream'
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        body_path = variant_path(rel_path, encoding) if encoding else path
+        key = (rel_path, encoding, entry['etag'])
+        with static_lock:
+            body = static_memory.get(key)
+            if body is not None:
+                static_memory.move_to_end(key)
+        if body is None and os.path.getsize(body_path) <= static_memory_max_file_bytes:
+            with open(body_path, 'rb') as f:
+                body = f.read()
+            remember_static(key, body)
+        if body is not None:
+            response = make_response(body)
+            response.mimetype = mimetype
+        else:
+            response = send_file(body_path, mimetype=mimetype, etag=False, conditional=False)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if immutable else 'no-cache'
+    return response
+
+# The frontend HTML with /static/ URLs pointing at the fingerprinted tree
+def frontend_response():
+    stat = os.stat(frontend_path)
+    tag = static_tag
+    if frontend_cache.get('mtime_ns') != stat.st_mtime_ns or frontend_cache.get('tag') != tag:
+        with open(frontend_path, 'r') as f:
+            html = f.read()
+        if tag != 'dev':
+            html = html.replace('/static/', f'/static/_v/{tag}/')
+        body = html.encode('utf-8')
+        frontend_cache.update({'mtime_ns': stat.st_mtime_ns, 'tag': tag, 'etag': hashlib.sha256(body).hexdigest()[:16], 'body': body, 'gzip': gzip.compress(body, 9)})
+    use_gzip = bool(request.accept_encodings['gzip'])
+    etag = frontend_cache['etag'] + ('-gzip' if use_gzip else '')
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(frontend_cache['gzip'] if use_gzip else frontend_cache['body'])
+        response.mimetype = 'text/html'
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+load_static_manifest()
+mark_startup('static manifest')
 
 # Serve the frontend HTML
 @app.route('/')
 def index():
-    return send_from_directory('.', 'ObscyrusFE1.1.html')
+    return frontend_response()
 
 # Serve static files
 @app.route('/static/<path:path>')
 def serve_static(path):
-    return send_from_directory('static', path)
+    return serve_static_file(path)
+
+# Serve fingerprinted static files; the tag changes whenever any asset does
+@app.route('/static/_v/<tag>/<path:path>')
+def serve_versioned_static(tag, path):
+    return serve_static_file(path, immutable=(tag == static_tag))
+
+# Prometheus metrics
+@app.route('/metrics')
+def metrics():
+    response = make_response(render_metrics())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+# Sampling profiler: POST {"action": "start" | "stop" | "reset", "interval": seconds, "include_idle": bool}
+@app.route('/api/profiler', methods=['GET', 'POST'])
+def profiler_control():
+    if request.method == 'POST':
+        data = request.json or {}
+        action = data.get('action')
+        if action == 'start':
+            start_profiler(data.get('interval'), data.get('include_idle', False))
+        elif action == 'stop':
+            stop_profiler()
+        elif action == 'reset':
+            reset_profiler()
+        else:
+            return jsonify({'error': 'Action must be start, stop or reset'}), 400
+    with profiler_lock:
+        stacks = sorted(profiler['stacks'].items(), key=lambda item: -item[1])
+        status = {'running': profiler['running'], 'interval': profiler_interval, 'samples': profiler['samples'], 'started': profiler['started']}
+    if request.args.get('format') == 'collapsed':
+        response = make_response(''.join(f'{stack} {samples}\n' for stack, samples in stacks))
+        response.mimetype = 'text/plain'
+        return response
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(dict(status, stacks=[{'stack': stack.split(';'), 'samples': samples} for stack, samples in stacks[:limit]]))
 
 # API to get models
 @app.route('/api/models')
 def get_models():
-    return jsonify({'models': available_models})
+    models = list_models()
+    return jsonify({'models': models, 'info': model_metadata(models)})
 
 # API to save code (now saves to codes_dir)
 @app.route('/api/save_code', methods=['POST'])
@@ -89,6 +2112,8 @@ def save_code():
         save_path = os.path.join(codes_dir, filename)
         with open(save_path, 'w') as f:
             f.write(code)
+        queue_embedding('code', filename)
+        queue_code_index('codes', filename)
         return jsonify({'message': f'Code saved to {save_path}'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -111,6 +2136,10 @@ def rename_code():
         old_path = os.path.join(codes_dir, old_filename)
         new_path = os.path.join(codes_dir, new_filename)
         os.rename(old_path, new_path)
+        queue_embedding('code', old_filename, remove_only=True)
+        queue_embedding('code', new_filename)
+        queue_code_index('codes', old_filename, remove_only=True)
+        queue_code_index('codes', new_filename)
         return jsonify({'message': 'Code renamed'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -125,6 +2154,8 @@ def delete_code():
             return jsonify({'error': 'Filename required'}), 400
         path = os.path.join(codes_dir, filename)
         os.remove(path)
+        queue_embedding('code', filename, remove_only=True)
+        queue_code_index('codes', filename, remove_only=True)
         return jsonify({'message': 'Code deleted'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -137,15 +2168,15 @@ def get_code():
         filename = data.get('filename')
         if not filename:
             return jsonify({'error': 'Filename required'}), 400
+        options = parse_window_options(data)
         path = os.path.join(codes_dir, filename)
-        with open(path, 'r') as f:
-            code = f.read()
-        file_type = filename.split('.')[-1] if '.' in filename else 'text'
-        return jsonify({'code': code, 'lang': file_type})
+        return jsonify(read_code_file(path, filename, options))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# API to upload workspace
+# API to upload workspace (replaces the whole workspace)
 @app.route('/api/upload_workspace', methods=['POST'])
 def upload_workspace():
     try:
@@ -155,26 +2186,101 @@ def upload_workspace():
                 os.unlink(os.path.join(root, f))
             for d in dirs:
                 shutil.rmtree(os.path.join(root, d))
+        clear_workspace_index()
 
+        ensure_workspace_index()
         files = request.files.getlist('files[]')
+        transferred = 0
         for file in files:
-            rel_path = file.filename
-            full_path = os.path.join(workspace_dir, rel_path)
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            file.save(full_path)
-        return jsonify({'message': 'Workspace uploaded'})
+            written, sha256 = write_workspace_stream(file.filename, file.stream)
+            transferred += written
+        return jsonify({'message': 'Workspace uploaded', 'bytes_transferred': transferred})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# API to sync workspace against a client manifest
+@app.route('/api/workspace_sync', methods=['POST'])
+def workspace_sync():
+    try:
+        data = request.json
+        manifest = data.get('files')
+        if manifest is None:
+            return jsonify({'error': 'File manifest required'}), 400
+        ensure_workspace_index()
+        needed = []
+        skipped_bytes = 0
+        wanted = set()
+        for entry in manifest:
+            rel_path = entry['path']
+            path = safe_workspace_path(rel_path)
+            wanted.add(rel_path)
+            if os.path.isfile(path) and os.path.getsize(path) == entry['size'] and workspace_file_hash(rel_path) == entry['sha256']:
+                skipped_bytes += entry['size']
+            else:
+                needed.append(rel_path)
+        deleted = []
+        if data.get('delete_missing', True):
+            for rel_path in list_workspace_files():
+                if rel_path not in wanted:
+                    remove_workspace_file(rel_path)
+                    deleted.append(rel_path)
+        return jsonify({'needed': needed, 'deleted': deleted, 'skipped_files': len(manifest) - len(needed), 'skipped_bytes': skipped_bytes})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# API to upload one workspace file; the raw request body is the file content
+@app.route('/api/workspace_file', methods=['PUT'])
+def put_workspace_file():
+    try:
+        rel_path = request.args.get('path')
+        if not rel_path:
+            return jsonify({'error': 'Path required'}), 400
+        ensure_workspace_index()
+        written, sha256 = write_workspace_stream(rel_path, request.stream, request.args.get('sha256'))
+        return jsonify({'path': rel_path, 'bytes_transferred': written, 'sha256': sha256})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # API to list workspace files
 @app.route('/api/workspace_files')
 def get_workspace_files():
-    files = []
-    for root, dirs, fns in os.walk(workspace_dir):
-        for fn in fns:
-            rel = os.path.relpath(os.path.join(root, fn), workspace_dir)
-            files.append(rel)
-    return jsonify({'files': files})
+    return jsonify({'files': list_workspace_files()})
+
+# API to search workspace and saved code
+@app.route('/api/search_code')
+def get_search_code():
+    query = request.args.get('q', '')
+    if not query:
+        return jsonify({'error': 'Query required'}), 400
+    limit = request.args.get('limit', code_search_default_limit, type=int)
+    started = time.time()
+    hits = search_code(query, limit)
+    # Hits are partial while the index is still being built
+    return jsonify({'hits': hits, 'indexing': code_index_building(), 'took_ms': round((time.time() - started) * 1000, 2)})
+
+# API to list one workspace directory, paginated, for lazy tree expansion
+@app.route('/api/workspace_tree')
+def get_workspace_tree():
+    dir_path = request.args.get('path', '')
+    if dir_path and not dir_path.endswith('/'):
+        dir_path += '/'
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(request.args.get('limit', workspace_tree_page_size, type=int), workspace_tree_page_size)
+    page = workspace_tree_page(dir_path, offset, limit)
+    if page is None:
+        return jsonify({'error': 'Directory not found'}), 404
+    etag = f"{workspace_index_epoch}-{page['version']}-{offset}-{limit}"
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(jsonify(page))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 # API to get workspace code content
 @app.route('/api/get_workspace_code', methods=['POST'])
@@ -184,102 +2290,1035 @@ def get_workspace_code():
         filename = data.get('filename')
         if not filename:
             return jsonify({'error': 'Filename required'}), 400
-        path = os.path.join(workspace_dir, filename)
-        with open(path, 'r') as f:
-            code = f.read()
-        file_type = filename.split('.')[-1] if '.' in filename else 'text'
-        return jsonify({'code': code, 'lang': file_type})
+        options = parse_window_options(data)
+        path = safe_workspace_path(filename)
+        return jsonify(read_code_file(path, filename, options))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# GGUF metadata.
+# /api/models describes each model (architecture, quantization, training context, size) from
+# its GGUF header without loading it. Only the header key/value section is read, stopping once
+# the wanted keys are found; results are cached in GGUFs/.metadata_cache.json by size and mtime.
+gguf_metadata_cache_path = os.path.join(models_dir, '.metadata_cache.json')
+gguf_metadata_cache = None  # filename: {'size': int, 'mtime_ns': int, 'info': dict}
+gguf_metadata_lock = threading.Lock()
+gguf_scalar_formats = {0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d'}
+# llama_ftype values as written to general.file_type
+gguf_file_types = {
+    0: 'F32', 1: 'F16', 2: 'Q4_0', 3: 'Q4_1', 7: 'Q8_0', 8: 'Q5_0', 9: 'Q5_1', 10: 'Q2_K', 11: 'Q3_K_S',
+    12: 'Q3_K_M', 13: 'Q3_K_L', 14: 'Q4_K_S', 15: 'Q4_K_M', 16: 'Q5_K_S', 17: 'Q5_K_M', 18: 'Q6_K',
+    19: 'IQ2_XXS', 20: 'IQ2_XS', 21: 'Q2_K_S', 22: 'IQ3_XS', 23: 'IQ3_XXS', 24: 'IQ1_S', 25: 'IQ4_NL',
+    26: 'IQ3_S', 27: 'IQ3_M', 28: 'IQ2_S', 29: 'IQ2_M', 30: 'IQ4_XS', 31: 'IQ1_M', 32: 'BF16',
+    36: 'TQ1_0', 37: 'TQ2_0',
+}
+
+def read_gguf_value(f, value_type):
+    if value_type == 8:
+        length, = struct.unpack('<Q', f.read(8))
+        return f.read(length).decode('utf-8', errors='replace')
+    if value_type == 9:
+        item_type, count = struct.unpack('<IQ', f.read(12))
+        if item_type in gguf_scalar_formats:
+            # Arrays (e.g. tokenizer vocabularies) are skipped, not decoded
+            f.seek(struct.calcsize(gguf_scalar_formats[item_type]) * count, os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                read_gguf_value(f, item_type)
+        return None
+    fmt = gguf_scalar_formats[value_type]
+    return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+def read_gguf_header(path):
+    info = {'architecture': None, 'name': None, 'quantization': None, 'n_ctx_train': None}
+    with open(path, 'rb') as f:
+        if f.read(4) != b'GGUF':
+            raise ValueError('Not a GGUF file')
+        version, = struct.unpack('<I', f.read(4))
+        if version < 2:
+            raise ValueError(f'Unsupported GGUF version {version}')
+        tensor_count, kv_count = struct.unpack('<QQ', f.read(16))
+        for _ in range(kv_count):
+            key_length, = struct.unpack('<Q', f.read(8))
+            key = f.read(key_length).decode('utf-8', errors='replace')
+            value_type, = struct.unpack('<I', f.read(4))
+            value = read_gguf_value(f, value_type)
+            if key == 'general.architecture':
+                info['architecture'] = value
+            elif key == 'general.name':
+                info['name'] = value
+            elif key == 'general.file_type':
+                info['quantization'] = gguf_file_types.get(value, str(value))
+            elif info['architecture'] and key == f"{info['architecture']}.context_length":
+                info['n_ctx_train'] = value
+            if info['architecture'] and info['quantization'] and info['n_ctx_train'] and info['name']:
+                break
+    if info['quantization'] is None:
+        match = re.search(r'(?i)[._-]((?:I?Q\d\w*?)|F16|F32|BF16)(?=\.gguf$)', os.path.basename(path))
+        info['quantization'] = match.group(1).upper() if match else None
+    return info
+
+def model_metadata(models):
+    global gguf_metadata_cache
+    with gguf_metadata_lock:
+        if gguf_metadata_cache is None:
+            gguf_metadata_cache = {}
+            if os.path.exists(gguf_metadata_cache_path):
+                try:
+                    with open(gguf_metadata_cache_path, 'r') as f:
+                        gguf_metadata_cache = json.load(f)
+                except Exception:
+                    pass
+        result = {}
+        changed = False
+        for model in models:
+            stat = os.stat(os.path.join(models_dir, model))
+            entry = gguf_metadata_cache.get(model)
+            if not entry or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                try:
+                    info = read_gguf_header(os.path.join(models_dir, model))
+                except Exception as e:
+                    info = {'error': str(e)}
+                entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'info': info}
+                gguf_metadata_cache[model] = entry
+                changed = True
+            result[model] = dict(entry['info'], size=stat.st_size)
+        for model in [model for model in gguf_metadata_cache if model not in models]:
+            del gguf_metadata_cache[model]
+            changed = True
+        if changed:
+            with open(gguf_metadata_cache_path + '.tmp', 'w') as f:
+                json.dump(gguf_metadata_cache, f)
+            os.replace(gguf_metadata_cache_path + '.tmp', gguf_metadata_cache_path)
+        return result
+
+# Model pool.
+# Keeps up to max_resident_models loaded models within model_ram_budget_bytes (estimated
+# from the GGUF file size) and evicts the least recently used one that is not active.
+# Load parameters come from model_load_defaults, overridden per model by GGUFs/models.json:
+#   {"default": {"n_threads": 8}, "Obscyrus1-8B-ClaudeFT.gguf": {"n_ctx": 8192}}
+# The same file names the semantic search model: {"embedding_model": "nomic-embed-text-v1.5.Q8_0.gguf"}
+max_resident_models = 2
+model_ram_budget_bytes = 16 * 1024 ** 3
+model_load_defaults = {'n_ctx': 18000, 'n_gpu_layers': 20, 'n_threads': None, 'use_mmap': True, 'use_mlock': False}
+model_config_path = os.path.join(models_dir, 'models.json')
+model_pool = OrderedDict()  # model: {'llm': Llama, 'size': int, 'logits_all': bool}
+models_loading = {}  # model: [sid waiting for it]
+model_pool_lock = threading.Lock()
+
+def get_model_params(model):
+    params = dict(model_load_defaults)
+    if os.path.exists(model_config_path):
+        with open(model_config_path, 'r') as f:
+            config = json.load(f)
+        params.update(config.get('default', {}))
+        params.update(config.get(model, {}))
+    return {key: value for key, value in params.items() if value is not None}
+
+def evict_models():
+    with model_pool_lock:
+        candidates = [name for name in model_pool if name != current_model]
+        total = sum(entry['size'] for entry in model_pool.values())
+        while candidates and (len(model_pool) > max_resident_models or total > model_ram_budget_bytes):
+            name = candidates.pop(0)
+            total -= model_pool.pop(name)['size']
+            system_prefixes.pop(name, None)
+            socketio.emit('model_progress', {'model': name, 'status': 'evicted'})
+
+# Speculative decoding.
+# select_model takes an optional draft: 'prompt_lookup' drafts from n-grams already in the
+# context (good for /edit, where most of the answer copies current_code), or the name of a
+# small GGUF in GGUFs/ that shares the main model's vocabulary. The draft is attached as the
+# main model's draft_model. llama-cpp-python then needs logits for every position
+# (logits_all), so a resident model loaded without them is reloaded. Acceptance is estimated
+# per response: every verification step yields its accepted drafts plus one sampled token.
+speculative_draft_tokens = 10
+model_drafts = {}  # model: 'prompt_lookup' or draft GGUF name
+active_draft = None  # DraftCounter attached to llm, or None
+draft_llms = {}  # draft GGUF name: Llama (one at a time)
+
+class GGUFDrafter:
+    def __init__(self, draft_llm, num_pred_tokens=speculative_draft_tokens):
+        self.llm = draft_llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        ids = input_ids.tolist()
+        if not ids or len(ids) + self.num_pred_tokens > self.llm.n_ctx():
+            return np.array([], dtype=np.intc)
+        # Keep the draft model's evaluated prefix; the last token is re-evaluated for fresh logits
+        common = 0
+        for a, b in zip(self.llm.input_ids[:self.llm.n_tokens].tolist(), ids):
+            if a != b:
+                break
+            common += 1
+        common = min(common, len(ids) - 1)
+        self.llm.n_tokens = common
+        self.llm.eval(ids[common:])
+        tokens = []
+        for i in range(self.num_pred_tokens):
+            token = self.llm.sample(temp=0.0)
+            tokens.append(token)
+            if i + 1 < self.num_pred_tokens:
+                self.llm.eval([token])
+        return np.array(tokens, dtype=np.intc)
+
+class DraftCounter:
+    def __init__(self, name, drafter):
+        self.name = name
+        self.drafter = drafter
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.drafted = 0
+
+    def __call__(self, input_ids, **kwargs):
+        draft = self.drafter(input_ids, **kwargs)
+        self.calls += 1
+        self.drafted += len(draft)
+        return draft
+
+def valid_draft(draft, model):
+    return draft is None or draft == 'prompt_lookup' or (draft != model and draft in list_models())
+
+def make_draft(draft):
+    if draft is None:
+        return None
+    if draft == 'prompt_lookup':
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+        return DraftCounter(draft, LlamaPromptLookupDecoding(num_pred_tokens=speculative_draft_tokens))
+    if draft not in draft_llms:
+        draft_llms.clear()
+        draft_llms[draft] = offload(new_llama, os.path.join(models_dir, draft), verbose=False, **get_model_params(draft))
+    return DraftCounter(draft, GGUFDrafter(draft_llms[draft]))
+
+def draft_stats(completion_tokens):
+    if active_draft is None or not active_draft.calls:
+        return {}
+    accepted = max(0, completion_tokens - active_draft.calls)
+    rate = accepted / active_draft.drafted if active_draft.drafted else 0.0
+    return {'draft': active_draft.name, 'drafted_tokens': active_draft.drafted, 'accepted_tokens': accepted, 'acceptance_rate': round(rate, 3)}
+
+# Per-client conversation state, keyed by Socket.IO sid
+sessions = {}  # sid: session state, see new_session_state
+
+def new_session_state(convo_id=None, history=None):
+    return {
+        'convo_id': convo_id,
+        'history': history if history is not None else [],
+        'window_start': 0,  # first history message sent to the model
+        'summary': '',  # rolling summary of history[:summary_upto]
+        'summary_upto': 0,
+        'summarizing': False,
+        'saved_count': 0,  # history messages already in the conversation store
+    }
+
+# Sessions are created only on connect. Jobs that finish after their client disconnected
+# get None rather than a new session that nothing would ever remove.
+def get_session(sid=None, create=False):
+    sid = sid or request.sid
+    if create and sid not in sessions:
+        sessions[sid] = new_session_state()
+    return sessions.get(sid)
+
+# KV cache key for a session: the conversation id, or the sid while still unsaved
+def session_kv_key(sid):
+    session = get_session(sid)
+    return session['convo_id'] if session and session['convo_id'] else ('unsaved', sid)
+
+# Context window manager.
+# Each turn sends the system prompt plus the most recent messages that fit in the token
+# budget. When the history outgrows it, the window start jumps forward (to 3/4 of the
+# budget, so the cached prefix stays valid for several turns) and the messages that fell
+# out are folded into a rolling summary by a background job.
+context_token_budget = 12000
+response_token_reserve = 2048
+summary_max_tokens = 300
+summary_message_chars = 2000
+token_count_cache = OrderedDict()  # (model, text): token count
+token_count_cache_size = 10000
+
+def count_tokens_cached(text):
+    key = (current_model, text)
+    count = token_count_cache.get(key)
+    if count is None:
+        count = count_tokens(text)
+        token_count_cache[key] = count
+        if len(token_count_cache) > token_count_cache_size:
+            token_count_cache.popitem(last=False)
+    else:
+        token_count_cache.move_to_end(key)
+    return count
+
+def context_budget():
+    return min(context_token_budget, llm.n_ctx() - response_token_reserve)
+
+def build_context_messages(sid, system_content):
+    session = get_session(sid)
+    history = session['history']
+    if session['summary']:
+        system_content += f"\nSummary of the earlier conversation:\n{session['summary']}"
+    budget = context_budget() - count_tokens_cached(system_content)
+    counts = [count_tokens_cached(msg.get('content') or '') for msg in history]
+    start = session['window_start']
+    if sum(counts[start:]) > budget:
+        used = sum(counts[start:])
+        # Always keep the newest message, and start the window on a user turn
+        while start < len(history) - 1 and (used > budget * 3 // 4 or history[start]['role'] != 'user'):
+            used -= counts[start]
+            start += 1
+        session['window_start'] = start
+    if session['window_start'] > session['summary_upto'] and not session['summarizing']:
+        session['summarizing'] = True
+        if submit_job(None, lambda job: summarize_history(job, sid), PRIORITY_BACKGROUND) is None:
+            # Queue full: leave the flag clear so the next turn tries again
+            session['summarizing'] = False
+    return [{"role": "system", "content": system_content}] + history[session['window_start']:]
+
+def summarize_history(job, sid):
+    global kv_active_key
+    session = get_session(sid)
+    if session is None:
+        return
+    upto = session['window_start']
+    folded = session['history'][session['summary_upto']:upto]
+    transcript = '\n\n'.join(f"{msg['role']}: {(msg.get('content') or '')[:summary_message_chars]}" for msg in folded)
+    messages = [
+        {"role": "system", "content": "You keep a concise running summary of a conversation between a user and Obscyrus. Keep names, decisions, file names and open tasks. Describe code instead of reproducing it."},
+        {"role": "user", "content": f"Current summary:\n{session['summary'] or '(none)'}\n\nNew messages:\n{transcript}\n\nWrite the updated summary."},
+    ]
+    try:
+        completion = offload(job.llm.create_chat_completion, messages, max_tokens=summary_max_tokens, stream=False)
+        session['summary'] = completion['choices'][0]['message']['content'].strip()
+        session['summary_upto'] = upto
+    finally:
+        session['summarizing'] = False
+        # The summary request replaced the conversation's tokens in llm
+        if job.llm is llm:
+            kv_active_key = kv_no_state
+
+# /edit payload deduplication: if the editor still holds exactly the code from the
+# previous assistant reply or the previous /edit message, refer to it instead of
+# storing the whole file in history again.
+def extract_code_block(text):
+    start = text.find('```')
+    if start == -1:
+        return None
+    end_lang = text.find('\n', start + 3)
+    if end_lang == -1:
+        return None
+    end = text.find('```', end_lang + 1)
+    return text[end_lang + 1:end if end != -1 else len(text)].strip()
+
+def code_for_edit_prompt(session, current_code):
+    history = session['history']
+    code = current_code.strip()
+    for i in range(len(history) - 1, max(session['window_start'], len(history) - 2) - 1, -1):
+        msg = history[i]
+        content = msg.get('content') or ''
+        if msg['role'] == 'assistant' and extract_code_block(content) == code:
+            return "(unchanged: the code block from your previous response)"
+        if msg['role'] == 'user' and content.endswith(f"\n\nCurrent code to edit:\n{current_code}"):
+            return "(unchanged since my previous /edit message)"
+    return current_code
+
+# Patch-based /edit.
+# For larger files only the regions relevant to the request are sent (the editor
+# selection, or the symbols that share words with the prompt), and the model answers with
+# SEARCH/REPLACE blocks that the server applies to current_code. Output then scales
+# with the size of the change instead of the size of the file.
+patch_edit_min_lines = 150
+patch_edit_max_lines = 300
+patch_context_lines = 3
+patch_edit_instructions = """
+
+Do not output the whole file. Reply with a brief explanation, then one or more edits in exactly this format:
+<<<<<<< SEARCH
+(lines copied exactly from the current code)
+=======
+(the lines that replace them)
+>>>>>>> REPLACE
+Keep each SEARCH part short but unique: the changed lines plus a line or two around them."""
+symbol_pattern = re.compile(r'^[ \t]*(?:(?:async[ \t]+)?def|class|function|(?:export[ \t]+)?(?:const|let|var))[ \t]+([A-Za-z_$][\w$]*)|^[ \t]*<\w+[^>]*\bid=["\']([^"\']+)', re.M)
+patch_block_pattern = re.compile(r'<<<<<<< SEARCH\n(.*?)\n?=======\n(.*?)\n?>>>>>>> REPLACE', re.S)
+
+def use_patch_edit(current_code, edit_mode):
+    if edit_mode in ('patch', 'full'):
+        return edit_mode == 'patch'
+    return current_code.count('\n') + 1 >= patch_edit_min_lines
+
+# Line ranges (0-based, end exclusive) of the code relevant to the prompt
+def select_edit_regions(code, prompt, selection=None):
+    lines = code.split('\n')
+    if selection and selection.get('start_line'):
+        start = max(0, int(selection['start_line']) - 1 - patch_context_lines)
+        end = min(len(lines), int(selection.get('end_line') or selection['start_line']) + patch_context_lines)
+        return [(start, end)]
+    starts = sorted({code.count('\n', 0, match.start()) for match in symbol_pattern.finditer(code)} | {0})
+    words = {word for word in tokenize_text(prompt) if len(word) > 2}
+    scored = []
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(lines)
+        block_words = tokenize_text('\n'.join(lines[start:end]))
+        header_words = tokenize_text(lines[start])
+        score = sum(3 for word in words if word in header_words) + len(words.intersection(block_words))
+        if score:
+            scored.append((score, start, end))
+    regions = []
+    used = 0
+    for score, start, end in sorted(scored, reverse=True):
+        start = max(0, start - patch_context_lines)
+        end = min(len(lines), end + patch_context_lines)
+        if used + end - start > patch_edit_max_lines:
+            continue
+        regions.append((start, end))
+        used += end - start
+    regions.sort()
+    merged = []
+    for start, end in regions:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def build_patch_edit_prompt(code, prompt, selection=None):
+    lines = code.split('\n')
+    regions = select_edit_regions(code, prompt, selection)
+    if not regions:
+        regions = [(0, len(lines))]
+    parts = [f"\n\nRelevant parts of the current code (the file has {len(lines)} lines; everything else stays as it is):"]
+    for start, end in regions:
+        parts.append(f"Lines {start + 1}-{end}:\n```\n" + '\n'.join(lines[start:end]) + "\n```")
+    return '\n'.join(parts) + patch_edit_instructions
+
+# Streams the explanation before the first SEARCH block and collects the blocks
+class PatchStream:
+    marker = '<<<<<<< SEARCH'
+
+    def __init__(self, on_text):
+        self.on_text = on_text
+        self.buffer = ''
+        self.in_blocks = False
+        self.started_text = False
+
+    def feed(self, text):
+        self.buffer += text
+        if self.in_blocks:
+            return
+        found = self.buffer.find(self.marker)
+        if found != -1:
+            # Drop an opening code fence the model may have put around the blocks
+            self._emit_text(re.sub(r'```\w*\s*$', '', self.buffer[:found]))
+            self.buffer = self.buffer[found:]
+            self.in_blocks = True
+            return
+        # Hold back a tail that could still become the marker or an opening fence
+        cut = len(self.buffer)
+        for i in range(max(0, len(self.buffer) - len(self.marker) - 20), len(self.buffer)):
+            if self.buffer[i] == '`' or (self.buffer[i] == '<' and self.marker.startswith(self.buffer[i:])):
+                cut = i
+                break
+        self._emit_text(self.buffer[:cut])
+        self.buffer = self.buffer[cut:]
+
+    def finish(self):
+        if not self.in_blocks:
+            self._emit_text(self.buffer)
+            self.buffer = ''
+
+    def patch_text(self):
+        return self.buffer if self.in_blocks else ''
+
+    def _emit_text(self, text):
+        if not self.started_text:
+            text = text.lstrip()
+        if text:
+            self.started_text = True
+            self.on_text(text)
+
+def leading_whitespace(lines):
+    for line in lines:
+        if line.strip():
+            return line[:len(line) - len(line.lstrip())]
+    return ''
+
+# First run of whole lines matching the SEARCH lines: exactly, or else with indentation and
+# trailing spaces ignored. Returns (start line, indentation found, indentation in SEARCH) or None.
+def find_block(lines, search_lines):
+    n = len(search_lines)
+    for i in range(len(lines) - n + 1):
+        if lines[i:i + n] == search_lines:
+            return i, '', ''
+    stripped = [line.strip() for line in search_lines]
+    for i in range(len(lines) - n + 1):
+        if all(lines[i + j].strip() == stripped[j] for j in range(n)):
+            return i, leading_whitespace(lines[i:i + n]), leading_whitespace(search_lines)
+    return None
+
+# Shift REPLACE lines by the difference between the matched code's indentation and the SEARCH part's
+def reindent(replace_lines, found_indent, search_indent):
+    if found_indent == search_indent:
+        return replace_lines
+    shifted = []
+    for line in replace_lines:
+        if not line.strip():
+            shifted.append(line)
+        elif line.startswith(search_indent):
+            shifted.append(found_indent + line[len(search_indent):])
+        else:
+            shifted.append(found_indent + line.lstrip())
+    return shifted
+
+# Apply SEARCH/REPLACE blocks; returns (patched code, applied count, failed SEARCH parts)
+def apply_patch_blocks(code, patch_text):
+    applied = 0
+    failed = []
+    lines = code.split('\n')
+    for search, replace in patch_block_pattern.findall(patch_text):
+        if not search.strip():
+            failed.append(search)
+            continue
+        search_lines = search.split('\n')
+        found = find_block(lines, search_lines)
+        if found is None:
+            failed.append(search)
+            continue
+        start, found_indent, search_indent = found
+        replace_lines = reindent(replace.split('\n'), found_indent, search_indent) if replace else []
+        lines[start:start + len(search_lines)] = replace_lines
+        applied += 1
+    return '\n'.join(lines), applied, failed
+
+# Inference worker pool.
+# With --inference-workers N, completions run in N worker processes (ObscyrusWorker.py) instead of
+# in this process, one scheduler thread per worker, so N sessions generate at once and a crash in
+# llama.cpp only takes down a worker. Workers map the GGUF with mmap, so the weights are shared
+# through the page cache rather than duplicated, and split the CPU threads between them unless
+# GGUFs/models.json sets n_threads. This process keeps a vocab-only load of the model for token
+# counting. Streams come back over each worker's pipe and are emitted to the job's sid as usual.
+# Jobs prefer the worker that served their session last, where the prompt prefix is still
+# evaluated; KV snapshots and speculative drafting are only used in-process. A worker that dies
+# is restarted, and the job it was running gets an error.
+inference_workers = serve_args.inference_workers
+worker_processes = []  # WorkerProcess per scheduler thread
+session_workers = {}  # sid: index of the worker that last ran a job for it
+worker_job_ids = itertools.count()
+worker_health_interval = 5
+
+class WorkerProcess:
+    def __init__(self, index):
+        self.index = index
+        self.restarts = 0
+        self.start()
+
+    def start(self):
+        if app_dir not in sys.path:
+            sys.path.insert(0, app_dir)
+        import ObscyrusWorker
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=ObscyrusWorker.serve, args=(child_conn, models_dir), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.model = None
+        self.failed_model = None
+
+    def restart(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(5)
+        self.restarts += 1
+        increment('obscyrus_worker_restarts_total')
+        print(f'Inference worker {self.index} exited with code {self.process.exitcode}; restarting')
+        self.start()
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+        except (OSError, ValueError):
+            self.restart()
+            raise RuntimeError('Inference worker crashed and was restarted')
+
+    def receive(self):
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError):
+            self.restart()
+            raise RuntimeError('Inference worker crashed and was restarted')
+
+    # Next reply for job_id, skipping any left over from an earlier job's stream
+    def receive_job(self, job_id):
+        while True:
+            reply = self.receive()
+            if reply[1] == job_id:
+                return reply
+
+    def ensure_model(self, model):
+        if self.model == model:
+            return
+        self.send(('load', model, worker_model_params(model)))
+        reply = self.receive()
+        while reply[0] in ('chunk', 'done') or (reply[0] == 'error' and reply[1] is not None):
+            reply = self.receive()
+        if reply[0] == 'error':
+            raise RuntimeError(f'Inference worker could not load {model}: {reply[2]}')
+        self.model = model
+
+# Completions on a worker, with the create_chat_completion interface the jobs use in-process
+class RemoteLlama:
+    def __init__(self, worker, model):
+        self.worker = worker
+        self.model = model
+
+    def create_chat_completion(self, messages, stream=False, **kwargs):
+        self.worker.ensure_model(self.model)
+        job_id = next(worker_job_ids)
+        self.worker.send(('complete', job_id, messages, dict(kwargs, stream=stream)))
+        if stream:
+            return RemoteStream(self.worker, job_id)
+        reply = self.worker.receive_job(job_id)
+        if reply[0] == 'error':
+            raise RuntimeError(reply[2])
+        return reply[2]
+
+class RemoteStream:
+    def __init__(self, worker, job_id):
+        self.worker = worker
+        self.job_id = job_id
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        reply = self.worker.receive_job(self.job_id)
+        if reply[0] == 'chunk':
+            return reply[2]
+        self.finished = True
+        if reply[0] == 'error':
+            raise RuntimeError(reply[2])
+        raise StopIteration
+
+    def close(self):
+        if self.finished:
+            return
+        self.worker.send(('cancel', self.job_id))
+        # Drain what the worker sent before it saw the cancel
+        for _ in self:
+            pass
+
+# Stands in for llm in this process: tokenizes with a vocab-only load of the GGUF
+class PoolModel:
+    def __init__(self, model):
+        self.model = model
+        self.params = worker_model_params(model)
+        self.vocab = new_llama(os.path.join(models_dir, model), vocab_only=True, verbose=False)
+
+    def tokenize(self, *args, **kwargs):
+        return self.vocab.tokenize(*args, **kwargs)
+
+    def n_ctx(self):
+        return self.params.get('n_ctx', 512)
+
+def worker_model_params(model):
+    params = get_model_params(model)
+    params.setdefault('n_threads', max(1, (os.cpu_count() or 1) // inference_workers))
+    return params
+
+# Inference scheduler.
+# All work that touches llm runs on one worker thread (one per worker process in pool
+# mode), taken from a bounded queue in (priority, arrival) order. Waiting clients get
+# 'queued' events with their position, and jobs belonging to a disconnected client are
+# cancelled. A job runs its completions on job.llm.
+max_queued_jobs = 16
+job_queue = []  # sorted by (priority, seq)
+job_cond = threading.Condition()
+job_seq = itertools.count()
+running_jobs = []
+worker_started = False
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+class InferenceJob:
+    def __init__(self, sid, run, priority):
+        self.sid = sid
+        self.run = run
+        self.priority = priority
+        self.seq = next(job_seq)
+        self.cancelled = False
+        self.submitted = time.perf_counter()
+        self.queue_wait = 0.0
+        self.llm = None
+
+    def sort_key(self):
+        return (self.priority, self.seq)
+
+def submit_job(sid, run, priority=PRIORITY_INTERACTIVE):
+    global worker_started
+    with job_cond:
+        if len(job_queue) >= max_queued_jobs:
+            return None
+        job = InferenceJob(sid, run, priority)
+        index = len(job_queue)
+        while index > 0 and job_queue[index - 1].sort_key() > job.sort_key():
+            index -= 1
+        job_queue.insert(index, job)
+        busy = len(running_jobs) >= max(1, inference_workers) or index > 0
+        if not worker_started:
+            worker_started = True
+            start_inference_workers()
+        job_cond.notify()
+    if busy:
+        notify_queue_positions()
+    return job
+
+def cancel_jobs(sid):
+    with job_cond:
+        job_queue[:] = [job for job in job_queue if job.sid != sid]
+        for job in running_jobs:
+            if job.sid == sid:
+                job.cancelled = True
+        session_workers.pop(sid, None)
+    notify_queue_positions()
+
+def notify_queue_positions():
+    with job_cond:
+        waiting = [job for job in job_queue if job.sid is not None]
+    for position, job in enumerate(waiting, 1):
+        socketio.emit('queued', {'position': position}, to=job.sid)
+
+def start_inference_workers():
+    if not inference_workers:
+        socketio.start_background_task(inference_worker, None)
+        return
+    for index in range(inference_workers):
+        worker = offload(WorkerProcess, index)
+        worker_processes.append(worker)
+        socketio.start_background_task(inference_worker, worker)
+
+# Next job for a worker, or None. A session's jobs never run side by side; among the top
+# priority, a job from a session this worker served last goes first.
+def take_job(worker):
+    busy = {job.sid for job in running_jobs if job.sid is not None}
+    ready = [index for index, job in enumerate(job_queue) if job.sid is None or job.sid not in busy]
+    if not ready:
+        return None
+    if worker is not None:
+        top = job_queue[ready[0]].priority
+        for index in ready:
+            job = job_queue[index]
+            if job.priority != top:
+                break
+            if job.sid is not None and session_workers.get(job.sid) == worker.index:
+                return job_queue.pop(index)
+    return job_queue.pop(ready[0])
+
+# Between jobs: restart the worker process if it died and load the selected model into it
+def maintain_worker(worker):
+    try:
+        if not worker.process.is_alive():
+            offload(worker.restart)
+        if llm is not None and worker.model != current_model and worker.failed_model != current_model:
+            offload(worker.ensure_model, current_model)
+    except Exception as e:
+        worker.failed_model = current_model
+        print(f'Inference worker {worker.index}: {e}')
+
+def worker_needs_care(worker):
+    return worker is not None and (not worker.process.is_alive() or (llm is not None and worker.model != current_model and worker.failed_model != current_model))
+
+def inference_worker(worker):
+    while True:
+        if worker_needs_care(worker):
+            maintain_worker(worker)
+        with job_cond:
+            job = take_job(worker)
+            while job is None and not worker_needs_care(worker):
+                job_cond.wait(worker_health_interval)
+                job = take_job(worker)
+            if job is None:
+                continue
+            running_jobs.append(job)
+            if worker is not None and job.sid is not None:
+                session_workers[job.sid] = worker.index
+        notify_queue_positions()
+        job.queue_wait = time.perf_counter() - job.submitted
+        observe('obscyrus_queue_wait_seconds', job.queue_wait, priority='interactive' if job.priority == PRIORITY_INTERACTIVE else 'background')
+        job.llm = llm if worker is None else RemoteLlama(worker, current_model)
+        try:
+            if not job.cancelled:
+                job.run(job)
+        except Exception as e:
+            if job.sid is not None:
+                socketio.emit('error', {'message': f'Error: {str(e)}'}, to=job.sid)
+        finally:
+            with job_cond:
+                running_jobs.remove(job)
+                job_cond.notify_all()
+
+def reject_busy():
+    increment('obscyrus_jobs_rejected_total')
+    emit('error', {'message': 'Server is busy, please try again shortly'})
+
 # SocketIO events
+@socketio.on('connect')
+def handle_connect(auth=None):
+    get_session(create=True)
+
+@socketio.on('disconnect')
+def handle_disconnect(reason=None):
+    sid = request.sid
+    cancel_jobs(sid)
+    sessions.pop(sid, None)
+    kv_cache_drop(('unsaved', sid))
+
+@socketio.on('cancel')
+def handle_cancel():
+    cancel_jobs(request.sid)
+
 @socketio.on('select_model')
 def handle_select_model(data):
-    global llm
     model = data.get('model')
+    draft = data.get('draft') or None
     if not model:
         emit('error', {'message': 'No model selected'})
         return
-    if model not in available_models:
+    if model not in list_models():
         emit('error', {'message': 'Invalid model'})
         return
+    if not valid_draft(draft, model):
+        emit('error', {'message': 'Invalid draft model'})
+        return
+    if draft is not None and inference_workers:
+        emit('error', {'message': 'Speculative decoding is not available with --inference-workers'})
+        return
+    model_drafts[model] = draft
+    if model in model_pool and (draft is None or model_pool[model]['logits_all']):
+        # Already resident: switch between inference jobs without reloading
+        emit('model_progress', {'model': model, 'status': 'resident'})
+        if submit_job(request.sid, lambda job: activate_model(job, model)) is None:
+            reject_busy()
+        return
+    sid = request.sid
+    with model_pool_lock:
+        if model in models_loading:
+            models_loading[model].append(sid)
+            return
+        models_loading[model] = [sid]
+    socketio.start_background_task(load_model, model, draft is not None)
+
+def load_model(model, logits_all=False):
+    started = time.time()
+    status = {'done': False}
+
+    def report_progress():
+        while not status['done']:
+            for sid in models_loading.get(model, []):
+                socketio.emit('model_progress', {'model': model, 'status': 'loading', 'elapsed': round(time.time() - started, 1)}, to=sid)
+            socketio.sleep(1)
+
+    socketio.start_background_task(report_progress)
     try:
+        # Built off the inference worker, so running generations on other models are not blocked
         model_path = os.path.join(models_dir, model)
-        llm = Llama(model_path, n_gpu_layers=20, n_ctx=18000, verbose=False)
-        emit('success', {'message': f'Loaded text model: {model}', 'type': 'text'})
+        if inference_workers:
+            # Workers load the weights; this process only needs the vocabulary
+            loaded = offload(PoolModel, model)
+        else:
+            params = get_model_params(model)
+            if logits_all:
+                params['logits_all'] = True
+            loaded = offload(new_llama, model_path, verbose=False, **params)
     except Exception as e:
-        emit('error', {'message': f'Error loading model: {str(e)}'})
+        status['done'] = True
+        with model_pool_lock:
+            waiting = models_loading.pop(model, [])
+        for sid in waiting:
+            socketio.emit('error', {'message': f'Error loading model: {str(e)}'}, to=sid)
+        return
+    status['done'] = True
+    observe('obscyrus_model_load_seconds', time.time() - started, model=model)
+    with model_pool_lock:
+        model_pool[model] = {'llm': loaded, 'size': os.path.getsize(model_path), 'logits_all': logits_all}
+        waiting = models_loading.pop(model, [])
+    for sid in waiting:
+        socketio.emit('model_progress', {'model': model, 'status': 'loaded', 'elapsed': round(time.time() - started, 1)}, to=sid)
+    if waiting:
+        submit_job(waiting[-1], lambda job: activate_model(job, model))
+
+# Runs on the inference worker so llm is never swapped mid-generation
+def activate_model(job, model):
+    global llm, current_model, kv_active_key, active_draft, kv_snapshots_enabled
+    with model_pool_lock:
+        entry = model_pool.get(model)
+        if entry is None:
+            socketio.emit('error', {'message': f'Model {model} is no longer loaded'}, to=job.sid)
+            return
+        model_pool.move_to_end(model)
+    llm = entry['llm']
+    current_model = model
+    kv_active_key = kv_no_state
+    kv_snapshots_enabled = not entry['logits_all']
+    evict_models()
+    if inference_workers:
+        # Each worker process loads the model when it next becomes idle
+        with job_cond:
+            job_cond.notify_all()
+    else:
+        try:
+            active_draft = make_draft(model_drafts.get(model)) if entry['logits_all'] else None
+        except Exception as e:
+            active_draft = None
+            socketio.emit('error', {'message': f'Error loading draft model: {str(e)}'}, to=job.sid)
+        llm.draft_model = active_draft
+        warm_system_prefix()
+    message = f'Loaded text model: {model}'
+    if active_draft is not None:
+        message += f' (drafting with {active_draft.name})'
+    socketio.emit('success', {'message': message, 'type': 'text'})
 
 @socketio.on('convo_list')
-def handle_convo_list():
-    convo_list = [{'id': id, 'name': convos[id]['name']} for id in convos]
-    emit('convo_list', {'convos': convo_list})
+def handle_convo_list(data=None):
+    data = data or {}
+    try:
+        offset = int(data.get('offset', 0))
+        limit = int(data.get('limit', convo_list_page_size))
+    except (TypeError, ValueError):
+        emit('error', {'message': 'Invalid conversation list page'})
+        return
+    emit('convo_list', convo_list_page(offset, limit, data.get('sort', 'updated')))
+
+# The newest messages of a long conversation are sent first; older pages are fetched on demand
+def convo_messages_page(id, messages, before=None, limit=convo_message_page_size):
+    end = len(messages) if before is None else max(0, min(before, len(messages)))
+    start = max(0, end - max(1, limit))
+    return {'id': id, 'messages': messages[start:end], 'start': start, 'total': len(messages)}
 
 @socketio.on('convo_create')
 def handle_convo_create():
-    global current_convo_id, current_history
-    current_convo_id = None
-    current_history = []
-    emit('convo_loaded', {'id': None, 'name': 'New Conversation', 'messages': []})
+    get_session().update(new_session_state())
+    kv_cache_drop(('unsaved', request.sid))
+    emit('convo_loaded', {'id': None, 'name': 'New Conversation', 'messages': [], 'start': 0, 'total': 0})
 
 @socketio.on('convo_load')
 def handle_convo_load(data):
-    global current_convo_id, current_history
     id = data.get('id')
     if id in convos:
-        current_convo_id = id
-        current_history = convos[id]['messages']
-        emit('convo_loaded', {'id': id, 'name': convos[id]['name'], 'messages': current_history})
+        session = get_session()
+        session.update(new_session_state(id, list(get_convo_messages(id))))
+        session['saved_count'] = len(session['history'])
+        emit('convo_loaded', dict(convo_messages_page(id, session['history']), name=convos[id]['name']))
+        # Warm the RAM cache from the saved snapshot, if any, before the next chat turn
+        if not inference_workers:
+            submit_job(None, lambda job: kv_cache_get(id, current_model) if llm is not None else None, PRIORITY_BACKGROUND)
     else:
         emit('error', {'message': 'Conversation not found'})
 
+@socketio.on('convo_messages')
+def handle_convo_messages(data):
+    id = data.get('id')
+    if id not in convos:
+        emit('error', {'message': 'Conversation not found'})
+        return
+    try:
+        before = int(data['before']) if data.get('before') is not None else None
+        limit = int(data.get('limit', convo_message_page_size))
+    except (TypeError, ValueError):
+        emit('error', {'message': 'Invalid message page'})
+        return
+    session = get_session()
+    # The open conversation may have unsaved turns; others are read from the store
+    messages = session['history'] if session['convo_id'] == id else get_convo_messages(id)
+    emit('convo_messages', convo_messages_page(id, messages, before, limit))
+
 @socketio.on('convo_save')
 def handle_convo_save(data):
-    global current_convo_id, current_history
     name = data.get('name')
-    if not name:
-        # Generate name using LLM
-        summary_prompt = {"role": "system", "content": "Summarize the conversation topic in 5 words or less."}
-        messages = [summary_prompt] + current_history
-        completion = llm.create_chat_completion(messages, stream=False)
-        name = completion['choices'][0]['message']['content'].strip()
-    if current_convo_id is None:
-        current_convo_id = str(uuid.uuid4())
-    convos[current_convo_id] = {'name': name, 'messages': current_history}
-    save_convo_to_file(current_convo_id, name, current_history)
-    emit('convo_saved', {'id': current_convo_id, 'name': name})
-    handle_convo_list()
+    if name:
+        save_session_convo(request.sid, name)
+        emit('convo_saved', {'id': get_session()['convo_id'], 'name': name})
+        return
+    if llm is None:
+        emit('error', {'message': 'No model loaded'})
+        return
+    if submit_job(request.sid, name_and_save_convo) is None:
+        reject_busy()
+
+def name_and_save_convo(job):
+    global kv_active_key
+    sid = job.sid
+    if get_session(sid) is None:
+        return
+    # Generate name using LLM. The conversation is sent unchanged with the naming
+    # request appended, so its cached prefix is reused and only the request is evaluated.
+    summary_prompt = {"role": "user", "content": "Summarize the conversation topic in 5 words or less. Reply with the topic only."}
+    messages = build_context_messages(sid, system_content_base) + [summary_prompt]
+    # Unchanged since it was last named: reuse the name
+    name = response_cache_get(current_model, messages)
+    if name is None:
+        if job.llm is llm:
+            restore_kv_state(session_kv_key(sid))
+        completion = offload(job.llm.create_chat_completion, messages, max_tokens=16, stream=False)
+        name = completion['choices'][0]['message']['content'].strip().strip('"')
+        # The naming request is now at the end of llm's tokens
+        if job.llm is llm:
+            kv_active_key = kv_no_state
+        response_cache_put(current_model, messages, name)
+    session = get_session(sid)
+    if session is None:
+        return
+    save_session_convo(sid, name)
+    socketio.emit('convo_saved', {'id': session['convo_id'], 'name': name}, to=sid)
+
+def save_session_convo(sid, name):
+    session = get_session(sid)
+    if session['convo_id'] is None:
+        session['convo_id'] = str(uuid.uuid4())
+        kv_cache_rekey(('unsaved', sid), session['convo_id'])
+    id = session['convo_id']
+    with timed('obscyrus_convo_save_seconds'):
+        save_convo(id, name, session['history'], session['saved_count'])
+        session['saved_count'] = len(session['history'])
+        index_convo(id)
+        queue_embedding('convo', id)
+        save_kv_state_to_file(id)
 
 @socketio.on('convo_rename')
 def handle_convo_rename(data):
     id = data.get('id')
     name = data.get('name')
     if id in convos:
-        convos[id]['name'] = name
-        save_convo_to_file(id, name, convos[id]['messages'])
+        rename_convo(id, name)
+        index_convo_name(id)
         emit('convo_renamed', {'id': id, 'name': name})
-        handle_convo_list()
     else:
         emit('error', {'message': 'Conversation not found'})
 
 @socketio.on('convo_delete')
 def handle_convo_delete(data):
-    global current_convo_id, current_history
     id = data.get('id')
     if id in convos:
-        del convos[id]
-        os.remove(os.path.join(convos_dir, f'{id}.json'))
-        if current_convo_id == id:
-            current_convo_id = None
-            current_history = []
+        delete_convo(id)
+        delete_kv_state_file(id)
+        unindex_convo(id)
+        queue_embedding('convo', id, remove_only=True)
+        for session in sessions.values():
+            if session['convo_id'] == id:
+                session.update(new_session_state())
         emit('convo_deleted', {'id': id})
-        handle_convo_list()
     else:
         emit('error', {'message': 'Conversation not found'})
 
 @socketio.on('chat')
 def handle_chat(data):
-    global current_history
     prompt = data.get('prompt')
     current_code = data.get('current_code', '')
     if not prompt:
@@ -288,89 +3327,214 @@ def handle_chat(data):
     if llm is None:
         emit('error', {'message': 'No model loaded'})
         return
+    selection = data.get('selection')
+    edit_mode = data.get('edit_mode')
+    current_lang = data.get('current_lang', '')
+    use_cache = not data.get('no_cache')
+    if submit_job(request.sid, lambda job: generate_response(job, prompt, current_code, selection, edit_mode, current_lang, use_cache)) is None:
+        reject_busy()
+
+# Output limits. Each mode gets its own max_tokens budget (None runs to the end of the context),
+# /generate and full-file /edit stop decoding as soon as the code block closes, and the optional
+# grammar constrains those replies to an explanation followed by a single fenced block.
+mode_max_tokens = {'generate': 4096, 'edit': 4096, 'search': 1024, 'chat': 2048}
+stop_at_closing_fence = True
+use_code_grammar = False
+code_grammar_gbnf = r'''
+root ::= explanation "```" lang "\n" line* "```"
+explanation ::= ([^`] | "`" [^`] | "``" [^`])*
+lang ::= [a-zA-Z0-9_+#.-]*
+line ::= ([^`\n] [^\n]* | "`" [^`\n] [^\n]* | "``" [^`\n] [^\n]*)? "\n"
+'''
+code_grammar_cache = None
+
+def prompt_mode(prompt):
+    return next((command for command in ('generate', 'edit', 'search') if prompt.startswith('/' + command)), 'chat')
+
+def code_grammar():
+    global code_grammar_cache
+    if code_grammar_cache is None:
+        from llama_cpp import LlamaGrammar
+        code_grammar_cache = LlamaGrammar.from_string(code_grammar_gbnf, verbose=False)
+    return code_grammar_cache
+
+def completion_options(job, mode, single_block):
+    options = {'max_tokens': mode_max_tokens.get(mode)}
+    if use_code_grammar and single_block:
+        # Worker processes build their own grammar from the GBNF text
+        options['grammar'] = code_grammar() if job.llm is llm else code_grammar_gbnf
+    return options
+
+# Timings and token counts for one response, recorded in the metrics and sent as 'stats'.
+# Streamed chunks carry one token each; prompt tokens are counted with the model's tokenizer.
+def response_stats(job, prompt, messages, chunks, cached, started, first_token_at, finished, stop_reason=None):
+    mode = prompt_mode(prompt)
+    prompt_tokens = sum(count_tokens_cached(message['content']) for message in messages)
+    stats = {'mode': mode, 'cached': cached, 'queue_wait': round(job.queue_wait, 3), 'prompt_tokens': prompt_tokens}
+    if cached:
+        return stats
+    prefill = first_token_at - started
+    decode = finished - first_token_at
+    stats.update({'prefill_seconds': round(prefill, 3), 'decode_seconds': round(decode, 3), 'completion_tokens': len(chunks)})
+    if stop_reason:
+        stats['stop_reason'] = stop_reason
+        increment('obscyrus_completion_stops_total', mode=mode, reason=stop_reason)
+    observe('obscyrus_prefill_seconds', prefill, mode=mode)
+    observe('obscyrus_prompt_tokens', prompt_tokens, mode=mode)
+    observe('obscyrus_completion_tokens', len(chunks), mode=mode)
+    if chunks:
+        observe('obscyrus_decode_seconds', decode, mode=mode)
+    if len(chunks) > 1 and decode > 0:
+        stats['tokens_per_second'] = round((len(chunks) - 1) / decode, 1)
+        observe('obscyrus_decode_tokens_per_second', stats['tokens_per_second'], mode=mode)
+    if job.llm is llm:
+        stats.update(draft_stats(len(chunks)))
+    if 'acceptance_rate' in stats:
+        observe('obscyrus_draft_acceptance_rate', stats['acceptance_rate'], mode=mode, draft=stats['draft'])
+    return stats
+
+def generate_response(job, prompt, current_code, selection=None, edit_mode=None, current_lang='', use_cache=True):
+    sid = job.sid
+    session = get_session(sid)
+    if session is None:
+        return
+    history = session['history']
     # Check for /search
     context = ''
     if prompt.startswith('/search '):
-        query = prompt[8:].lower()
-        for id, convo in convos.items():
-            for msg in convo['messages']:
-                if 'content' in msg and query in msg['content'].lower():
-                    context += f"From conversation {convo['name']}: {msg['content']}\n"
+        with timed('obscyrus_search_seconds', kind='convos'):
+            context = build_search_context(prompt[8:])
     system_content = system_content_base
     if context:
         system_content += f"\nPrevious related conversations:\n{context}"
-    local_system_prompt = {"role": "system", "content": system_content}
 
     # Handle /edit by appending current_code to prompt
     full_prompt = prompt
-    if prompt.startswith('/edit') and current_code:
-        full_prompt += f"\n\nCurrent code to edit:\n{current_code}"
+    patch_mode = bool(prompt.startswith('/edit') and current_code and use_patch_edit(current_code, edit_mode))
+    if patch_mode:
+        full_prompt += build_patch_edit_prompt(current_code, prompt, selection)
+    elif prompt.startswith('/edit') and current_code:
+        full_prompt += f"\n\nCurrent code to edit:\n{code_for_edit_prompt(session, current_code)}"
 
     # Add user message to history
-    current_history.append({"role": "user", "content": full_prompt})
+    history.append({"role": "user", "content": full_prompt})
 
-    # Prepare messages
-    messages = [local_system_prompt] + current_history
+    # Prepare messages: system prompt, rolling summary and the recent turns within budget
+    messages = build_context_messages(sid, system_content)
 
-    # Generate full response
+    # Attach the definitions of workspace symbols named in the prompt to this turn only
+    with timed('obscyrus_search_seconds', kind='code'):
+        code_context = build_code_context(prompt)
+    if code_context:
+        messages[-1] = {"role": "user", "content": f"{full_prompt}\n\nRelevant code from the workspace:\n{code_context}"}
+
+    # Stream the response token by token as the model produces it, or replay it from the cache
     try:
-        completion = llm.create_chat_completion(messages, stream=False)
-        response = completion['choices'][0]['message']['content']
-
-        # Parse the response
-        start_code = response.find('```')
-        if start_code != -1:
-            end_lang = response.find('\n', start_code + 3)
-            if end_lang != -1:
-                lang = response[start_code + 3:end_lang].strip()
-                end_code = response.find('```', end_lang + 1)
-                if end_code != -1:
-                    code = response[end_lang + 1:end_code].strip()
-                    explanation = response[:start_code].strip()
-                    after = response[end_code + 3:].strip()
-                else:
-                    code = response[end_lang + 1:].strip()
-                    explanation = response[:start_code].strip()
-                    after = ''
-            else:
-                explanation = response[:start_code].strip()
-                code = ''
-                after = response[start_code + 3:].strip()
-                lang = ''
+        kv_key = session_kv_key(sid)
+        mode = prompt_mode(prompt)
+        single_block = mode == 'generate' or (mode == 'edit' and not patch_mode)
+        if patch_mode:
+            parser = PatchStream(on_text=lambda token: socketio.emit('text_token', {'token': token}, to=sid))
         else:
-            explanation = response.strip()
-            code = ''
-            lang = ''
-            after = ''
-
-        # Simulate typing for explanation
-        for word in explanation.split():
-            emit('text_token', {'token': word + ' '})
-            time.sleep(0.05)  # Faster typing
-
-        # Emit code if any
-        if code:
-            emit('code', {'code': code, 'lang': lang})
+            parser = CodeFenceStream(
+                on_text=lambda token: socketio.emit('text_token', {'token': token}, to=sid),
+                on_code_token=lambda token, lang: socketio.emit('code_token', {'token': token, 'lang': lang}, to=sid),
+                on_code=lambda code, lang: socketio.emit('code', {'code': code, 'lang': lang}, to=sid),
+                drop_after=single_block and stop_at_closing_fence,
+            )
+        chunks = []
+        stop_reason = None
+        cached = response_cache_get(current_model, messages) if use_cache else None
+        started = first_token_at = time.perf_counter()
+        if cached is not None:
+            chunks.append(cached)
+            parser.feed(cached)
+        else:
+            if job.llm is llm:
+                restore_kv_state(kv_key)
+                if active_draft is not None:
+                    active_draft.reset()
+            options = completion_options(job, mode, single_block)
+            stream = offload(job.llm.create_chat_completion, messages, stream=True, **options)
+            # Closed however the loop ends, so a worker is never left with chunks for this job
+            try:
+                for chunk in offload_iter(stream):
+                    if job.cancelled:
+                        stop_reason = 'cancelled'
+                        break
+                    choice = chunk['choices'][0]
+                    delta = choice['delta'].get('content')
+                    if delta:
+                        if not chunks:
+                            first_token_at = time.perf_counter()
+                        chunks.append(delta)
+                        parser.feed(delta)
+                        # The code block has closed: anything after it would be thrown away
+                        if single_block and stop_at_closing_fence and parser.state == 'after':
+                            stop_reason = 'fence'
+                            break
+                    if choice.get('finish_reason'):
+                        stop_reason = choice['finish_reason']
+            finally:
+                offload(stream.close)
+        parser.finish()
+        finished = time.perf_counter()
+        response = ''.join(chunks)
+        if stop_reason == 'fence':
+            response = response[:response.rindex('```') + 3]
+        if cached is None and job.llm is llm:
+            snapshot_kv_state(kv_key)
+        if cached is None and not job.cancelled and response:
+            response_cache_put(current_model, messages, response)
 
-        # Simulate typing for after, if any
-        if after:
-            emit('text_token', {'token': '\n\n'})
-            for word in after.split():
-                emit('text_token', {'token': word + ' '})
-                time.sleep(0.05)
+        # Apply the edits and send the patched file through the usual code event
+        if patch_mode:
+            patched, applied, failed = apply_patch_blocks(current_code, parser.patch_text())
+            if applied:
+                socketio.emit('code', {'code': patched, 'lang': current_lang}, to=sid)
+            note = f"\n\n[Applied {applied} edit{'s' if applied != 1 else ''}"
+            if failed:
+                note += f", {len(failed)} could not be matched to the current code"
+            socketio.emit('text_token', {'token': note + ']'}, to=sid)
+        if cached is not None:
+            socketio.emit('text_token', {'token': '\n\n[Cached response, Shift+Enter to regenerate]'}, to=sid)
 
         # Emit end
-        emit('end_response')
+        socketio.emit('end_response', to=sid)
+        socketio.emit('stats', response_stats(job, prompt, messages, chunks, cached is not None, started, first_token_at, finished, stop_reason), to=sid)
 
         # Add to history
-        current_history.append({"role": "assistant", "content": response})
+        history.append({"role": "assistant", "content": response})
     except Exception as e:
-        emit('error', {'message': f'Error generating response: {str(e)}'})
+        socketio.emit('error', {'message': f'Error generating response: {str(e)}'}, to=sid)
+
+# Startup work deferred until the server is accepting connections
+def warm_start():
+    timings = []
+    for step, fn in (('convo scan', reconcile_convos), ('search index', ensure_search_index), ('vectors', ensure_vectors), ('code index', ensure_code_index),
+                     ('llama_cpp import', lambda: offload(importlib.import_module, 'llama_cpp')), ('static assets', build_static_assets)):
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print(f'Warm start step {step} failed: {e}')
+        timings.append((step, time.perf_counter() - started))
+    print(f'Warm start: {format_timings(timings)}')
 
 # Function to open browser
 def open_browser():
-    webbrowser.open_new('http://127.0.0.1:8854')
+    webbrowser.open_new(f'http://127.0.0.1:{serve_args.port}')
 
 if __name__ == '__main__':
-    Timer(1, open_browser).start()
-    socketio.run(app, host='0.0.0.0', port=8854, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    socketio.start_background_task(warm_start)
+    if not serve_args.no_browser:
+        Timer(1, open_browser).start()
+    mark_startup('routes')
+    print(f'Startup: {format_timings(startup_timings)}; ready in {(time.perf_counter() - startup_started) * 1000:.0f}ms')
+    print(f'Serving on {serve_args.host}:{serve_args.port} ({async_mode} mode)')
+    if async_mode == 'threading':
+        if serve_args.mode == 'auto':
+            print('eventlet or gevent not installed: using the Werkzeug development server')
+        socketio.run(app, host=serve_args.host, port=serve_args.port, allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, host=serve_args.host, port=serve_args.port)
\ No newline at end of file
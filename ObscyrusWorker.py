@@ -0,0 +1,67 @@
+# ObscyrusWorker.py - Inference worker process for Obscyrus1.1.py's worker pool mode (--inference-workers)
+# Each worker loads the selected GGUF with mmap, so the weights live once in the page cache and are
+# shared by every worker, and runs completions sent by the server over a multiprocessing pipe:
+#   ('load', model, params)            -> ('loaded', model) or ('error', None, message)
+#   ('complete', job_id, messages, kw) -> ('chunk', job_id, chunk)... then ('done', job_id, result)
+#                                         or ('error', job_id, message); a 'grammar' in kw is GBNF text
+#   ('cancel', job_id)                 stops a streamed completion early; any other message arriving
+#                                      mid-stream also stops it and is then handled
+#   ('stop',)                          exits
+import os
+
+def serve(conn, models_dir):
+    llm = None
+    model = None
+    grammars = {}
+    pending = None
+    while True:
+        if pending is not None:
+            message, pending = pending, None
+        else:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+        kind = message[0]
+        if kind == 'stop':
+            return
+        if kind == 'load':
+            _, name, params = message
+            try:
+                if name != model:
+                    # Drop the previous model before mapping the next one
+                    llm = None
+                    model = None
+                    from llama_cpp import Llama
+                    llm = Llama(os.path.join(models_dir, name), verbose=False, **params)
+                    model = name
+                conn.send(('loaded', name))
+            except Exception as e:
+                conn.send(('error', None, str(e)))
+        elif kind == 'complete':
+            _, job_id, messages, kwargs = message
+            try:
+                if kwargs.get('grammar') is not None:
+                    if kwargs['grammar'] not in grammars:
+                        from llama_cpp import LlamaGrammar
+                        grammars[kwargs['grammar']] = LlamaGrammar.from_string(kwargs['grammar'], verbose=False)
+                    kwargs['grammar'] = grammars[kwargs['grammar']]
+                if not kwargs.get('stream'):
+                    conn.send(('done', job_id, llm.create_chat_completion(messages, **kwargs)))
+                    continue
+                completion = llm.create_chat_completion(messages, **kwargs)
+                for chunk in completion:
+                    if conn.poll():
+                        incoming = conn.recv()
+                        # Anything but a cancel means the server gave up on this stream;
+                        # a cancel for an earlier job is ignored
+                        if incoming[0] != 'cancel':
+                            pending = incoming
+                        if pending is not None or incoming[1] == job_id:
+                            completion.close()
+                            break
+                    conn.send(('chunk', job_id, chunk))
+                conn.send(('done', job_id, None))
+            except Exception as e:
+                conn.send(('error', job_id, str(e)))
+        # A 'cancel' arriving here is for a stream that already finished
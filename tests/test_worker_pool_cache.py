@@ -0,0 +1,92 @@
+# A prompt answered by a worker process is written to the response cache, so the same prompt
+# from a fresh session is replayed from the cache. llama_cpp is replaced by a small fake
+# package that the spawned workers import as well.
+import os
+import sys
+import time
+import importlib.util
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+fake_llama_cpp = '''
+import numpy as np
+
+class LlamaState:
+    def __init__(self, ids):
+        self.input_ids = np.array(ids)
+        self.scores = np.zeros((0, 0))
+        self.llama_state_size = 10
+        self.n_tokens = len(ids)
+
+class Llama:
+    def __init__(self, path, **kwargs):
+        self.kwargs = kwargs
+        self.ids = []
+
+    def n_ctx(self):
+        return self.kwargs.get('n_ctx', 4096)
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return [hash(word) % 1000 for word in text.split()]
+
+    def save_state(self):
+        return LlamaState(self.ids)
+
+    def load_state(self, state):
+        self.ids = list(state.input_ids)
+
+    def embed(self, text):
+        return [1.0] * 8
+
+    def create_chat_completion(self, messages, stream=False, **kwargs):
+        answer = 'Here you go.'
+        if not stream:
+            return {'choices': [{'message': {'content': answer}}]}
+        return iter([{'choices': [{'delta': {'content': word + ' '}}]} for word in answer.split()])
+'''
+
+def wait_for(client, names, timeout=30):
+    deadline = time.time() + timeout
+    received = []
+    while time.time() < deadline:
+        received += client.get_received()
+        if any(event['name'] in names for event in received):
+            return received
+        time.sleep(0.05)
+    raise AssertionError(f'none of {names} within {timeout}s: {received}')
+
+@pytest.fixture
+def obscyrus(tmp_path, monkeypatch):
+    fake_dir = tmp_path / 'fake'
+    (fake_dir / 'llama_cpp').mkdir(parents=True)
+    (fake_dir / 'llama_cpp' / '__init__.py').write_text(fake_llama_cpp)
+    # Spawned workers start with the parent's sys.path
+    monkeypatch.syspath_prepend(str(fake_dir))
+    monkeypatch.delitem(sys.modules, 'llama_cpp', raising=False)
+    root = tmp_path / 'root'
+    (root / 'Obscyrus' / 'GGUFs').mkdir(parents=True)
+    (root / 'Obscyrus' / 'GGUFs' / 'fake.gguf').write_bytes(b'')
+    monkeypatch.setenv('OBSCYRUS_ROOT', str(root))
+    spec = importlib.util.spec_from_file_location('obscyrus', os.path.join(repo_dir, 'Obscyrus1.1.py'))
+    ob = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ob)
+    yield ob
+    for worker in ob.worker_processes:
+        worker.process.kill()
+
+def test_pool_responses_are_cached(obscyrus):
+    obscyrus.inference_workers = 1
+    first = obscyrus.socketio.test_client(obscyrus.app)
+    first.emit('select_model', {'model': 'fake.gguf'})
+    wait_for(first, ('success', 'error'))
+    assert obscyrus.worker_processes
+
+    stats = []
+    for client in (first, obscyrus.socketio.test_client(obscyrus.app)):
+        client.get_received()
+        client.emit('chat', {'prompt': 'same question'})
+        events = wait_for(client, ('stats', 'error'))
+        assert not [event for event in events if event['name'] == 'error']
+        stats += [event['args'][0] for event in events if event['name'] == 'stats']
+    assert [entry['cached'] for entry in stats] == [False, True]